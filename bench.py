@@ -0,0 +1,767 @@
+import os
+import re
+import sys
+import time
+import ftfy
+import random
+import difflib
+import argparse
+import tracemalloc
+import numpy as np
+
+from types import SimpleNamespace
+
+from datasets import _rocstories
+from text_utils import TextEncoder, get_pairs, text_standardize, fix_text
+from utils import ragged
+
+
+def legacy_bpe(token, bpe_ranks):
+    """
+    original merge loop, kept as the baseline for TextEncoder.bpe
+    """
+    word = tuple(token[:-1]) + (token[-1] + '</w>',)
+    pairs = get_pairs(word)
+    if not pairs:
+        return token+'</w>'
+    while True:
+        bigram = min(pairs, key=lambda pair: bpe_ranks.get(pair, float('inf')))
+        if bigram not in bpe_ranks:
+            break
+        first, second = bigram
+        new_word = []
+        i = 0
+        while i < len(word):
+            try:
+                j = word.index(first, i)
+                new_word.extend(word[i:j])
+                i = j
+            except ValueError:
+                new_word.extend(word[i:])
+                break
+            if word[i] == first and i < len(word)-1 and word[i+1] == second:
+                new_word.append(first+second)
+                i += 2
+            else:
+                new_word.append(word[i])
+                i += 1
+        word = tuple(new_word)
+        if len(word) == 1:
+            break
+        pairs = get_pairs(word)
+    word = ' '.join(word)
+    if word == '\n  </w>':
+        word = '\n</w>'
+    return word
+
+
+def legacy_text_standardize(text):
+    """
+    original text_standardize, kept as the reference for the fused version
+    """
+    text = text.replace('—', '-')
+    text = text.replace('–', '-')
+    text = text.replace('―', '-')
+    text = text.replace('…', '...')
+    text = text.replace('´', "'")
+    text = re.sub(r'''(-+|~+|!+|"+|;+|\?+|\++|,+|\)+|\(+|\+|\/+|\*+|\[+|\]+|}+|{+|\|+|_+)''', r' \1 ', text)
+    text = re.sub(r'\s*\n\s*', ' \n ', text)
+    text = re.sub(r'[^\S\n]+', ' ', text)
+    return text.strip()
+
+
+def bench_bpe(args):
+    text_encoder = TextEncoder(args.encoder_path, args.bpe_path)
+    rng = random.Random(args.seed)
+    words = [w.replace('</w>', '') for w in text_encoder.encoder]
+    words += [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(8, 40)))
+              for _ in range(args.n)]
+    words = [w for w in words if w]
+
+    mismatches = 0
+    for w in words:
+        text_encoder.cache.clear()
+        if text_encoder.bpe(w) != legacy_bpe(w, text_encoder.bpe_ranks):
+            mismatches += 1
+
+    t = time.time()
+    for w in words:
+        legacy_bpe(w, text_encoder.bpe_ranks)
+    t_legacy = time.time()-t
+
+    t = time.time()
+    for w in words:
+        text_encoder.cache.clear()
+        text_encoder.bpe(w)
+    t_new = time.time()-t
+
+    print('bpe: %d words, %d mismatches' % (len(words), mismatches))
+    print('legacy %.3fs  new %.3fs  speedup %.2fx' % (t_legacy, t_new, t_legacy/t_new))
+    if mismatches:
+        sys.exit('bpe: %d words merge differently from the legacy loop' % mismatches)
+
+
+def rocstories_texts(data_dir):
+    st, ct1, ct2, _ = _rocstories(os.path.join(data_dir, 'cloze_test_val__spring2016 - cloze_test_ALL_val.csv'))
+    return st + ct1 + ct2
+
+
+# contractions, abbreviations, quotes, currency, numbers and punctuation runs the corpus may lack
+PRETOK_CASES = [
+    "I can't believe it's not butter, she said.",
+    "He didn't want to go, but we'd already paid $20 for the tickets.",
+    "Mr. Smith met Dr. Jones at 5 p.m. on St. Patrick's Day.",
+    "\"Wait!\" she yelled. \"Don't leave yet.\"",
+    "They'll be here soon... I think.",
+    "The U.S. team won 3-2 in overtime!",
+    "She paid 50% of the $1,200.50 bill.",
+    "It was the dog's toy, not the cats' toy.",
+    "We're going to the store; you're staying home.",
+    "'Hello,' he whispered.",
+    "The show starts at 7:30 tonight.",
+    "I'd've done it if I could've.",
+    "Her e-mail was jane@example.com, or so she said.",
+    "He scored #1 in the class & got an A+.",
+    "Isn't it great? Yes! Absolutely...",
+    "Tom's brother's car broke down (again).",
+    "She said: \"no way\" and left.",
+    "The price rose to \u00a330 last year, etc.",
+    "Y'all ain't seen nothing yet.",
+    "Rock 'n' roll never dies.",
+    "He turned 21 on 12/25/2015.",
+    "What's up? Nothin' much.",
+    "The 1990s were fun; the '80s even more so.",
+    "I LOVE IT!!! Can't WAIT.",
+    "Go to www.google.com for details.",
+    "My mom (who's 60) loves cats.",
+    "He said it was 'fine' but it wasn't.",
+    "It costs 5 dollars, i.e. cheap.",
+    "Ms. Lee arrived at 10 a.m. sharp.",
+    "Gonna grab some coffee, wanna come?",
+]
+
+
+def agreement(docs_a, docs_b):
+    """
+    (% of tokens in matching runs, % of identical docs) between two tokenizations
+    """
+    n_same_docs = 0
+    n_matched = 0
+    n_tokens = 0
+    for a, b in zip(docs_a, docs_b):
+        n_same_docs += a == b
+        n_matched += 2*sum(block.size for block in difflib.SequenceMatcher(None, a, b, autojunk=False).get_matching_blocks())
+        n_tokens += len(a) + len(b)
+    return 100.*n_matched/max(n_tokens, 1), 100.*n_same_docs/max(len(docs_a), 1)
+
+
+def bench_pretok(args):
+    """
+    startup and throughput of both pretokenizers on the ROCStories texts, then a conformance
+    check of the regex one against spacy that fails below --min_agreement % of tokens
+    """
+    corpora = [('rocstories', [text_standardize(ftfy.fix_text(text)) for text in rocstories_texts(args.data_dir)]),
+               ('cases', [text_standardize(ftfy.fix_text(text)) for text in PRETOK_CASES])]
+    texts = corpora[0][1]
+    encoders = {}
+    for tokenizer in ['spacy', 'regex']:
+        t = time.time()
+        encoders[tokenizer] = TextEncoder(args.encoder_path, args.bpe_path, tokenizer=tokenizer)
+        t_startup = time.time()-t
+        t = time.time()
+        list(encoders[tokenizer].pretokenize(texts))
+        t_run = time.time()-t
+        n_mb = sum(len(text) for text in texts)/2**20
+        print('%s: startup %.2fs  %.0f texts/s  %.2f MB/s' % (tokenizer, t_startup, len(texts)/t_run, n_mb/t_run))
+
+    failed = []
+    for name, texts in corpora:
+        spacy_docs, regex_docs = (list(encoders[tokenizer].pretokenize(texts)) for tokenizer in ['spacy', 'regex'])
+        tokens, docs = agreement(spacy_docs, regex_docs)
+        print('%s agreement: %.2f%% of tokens, %.2f%% of texts identical' % (name, tokens, docs))
+        if tokens < args.min_agreement:
+            failed.append(name)
+        if name == 'cases':
+            for text, a, b in zip(texts, spacy_docs, regex_docs):
+                if a != b:
+                    print('  %r\n    spacy %s\n    regex %s' % (text, a, b))
+    if failed:
+        sys.exit('pretok: %s below %.2f%% token agreement with spacy' % (', '.join(failed), args.min_agreement))
+
+
+def bench_standardize(args):
+    rng = random.Random(args.seed)
+    alphabet = list('ab .,-~!";?+)(\\/*[]}{|_&\n\t\r\x0b\x0c\x1c\x85\xa0\u3000—–―…´\'é')
+    mismatches = 0
+    for _ in range(args.n):
+        text = ''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 40)))
+        if text_standardize(text) != legacy_text_standardize(text):
+            mismatches += 1
+        if fix_text(text) != ftfy.fix_text(text):
+            mismatches += 1
+    print('standardize: %d random texts, %d mismatches' % (args.n, mismatches))
+
+    texts = rocstories_texts(args.data_dir)
+    n_mb = sum(len(text) for text in texts)/2**20
+    for name, fn in [('legacy', lambda text: legacy_text_standardize(ftfy.fix_text(text))),
+                     ('fused', lambda text: text_standardize(fix_text(text)))]:
+        t = time.time()
+        for text in texts:
+            fn(text)
+        print('%s: %.3fs/MB' % (name, (time.time()-t)/n_mb))
+    if mismatches:
+        sys.exit('standardize: %d mismatches with the legacy functions' % mismatches)
+
+
+def legacy_transform_roc(X1, X2, X3, n_ctx, max_len, start, delimiter, clf_token, pos_start):
+    """
+    original per example packing loop from Model.transform_roc
+    """
+    n_batch = len(X1)
+    xmb = np.zeros((n_batch, 2, n_ctx, 2), dtype=np.int32)
+    mmb = np.zeros((n_batch, 2, n_ctx), dtype=np.float32)
+    for i, (x1, x2, x3), in enumerate(zip(X1, X2, X3)):
+        x12 = [start] + x1[:max_len] + [delimiter] + x2[:max_len] + [clf_token]
+        x13 = [start] + x1[:max_len] + [delimiter] + x3[:max_len] + [clf_token]
+        l12 = len(x12)
+        l13 = len(x13)
+        xmb[i, 0, :l12, 0] = x12
+        xmb[i, 1, :l13, 0] = x13
+        mmb[i, 0, :l12] = 1
+        mmb[i, 1, :l13] = 1
+    xmb[:, :, :, 1] = np.arange(pos_start, pos_start + n_ctx)
+    return xmb, mmb
+
+
+def measure(fn):
+    tracemalloc.start()
+    t = time.time()
+    result = fn()
+    elapsed = time.time()-t
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def bench_transform_roc(args):
+    from train import Model
+
+    rng = np.random.RandomState(args.seed)
+    n_vocab = 40478
+    fields = [[rng.randint(0, n_vocab, size=n).tolist() for n in rng.randint(lo, hi, size=args.n)]
+              for lo, hi in [(30, 80), (5, 20), (5, 20)]]
+    n_ctx = 512
+    model = SimpleNamespace(encoder={'_start_': n_vocab, '_delimiter_': n_vocab+1},
+                            clf_token=n_vocab+2, n_vocab=n_vocab, n_special=3,
+                            max_len=n_ctx//2-2, params={'n_ctx': n_ctx})
+    model.params["n_ctx"] = max(len(x1)+max(len(x2), len(x3)) for x1, x2, x3 in zip(*fields))+3
+
+    (xmb0, mmb0), t_legacy, peak_legacy = measure(lambda: legacy_transform_roc(
+        *fields, model.params["n_ctx"], model.max_len, n_vocab, n_vocab+1, n_vocab+2, n_vocab+3))
+    packed = [ragged(field) for field in fields]
+    (xmb1, mmb1), t_new, peak_new = measure(lambda: Model.transform_roc(model, *packed))
+
+    same = np.array_equal(xmb0, xmb1) and np.array_equal(mmb0, mmb1)
+    print('transform_roc: %d stories, n_ctx %d, identical %s' % (args.n, model.params["n_ctx"], same))
+    print('legacy %.3fs peak %.1fMB  vectorized %.3fs peak %.1fMB  speedup %.2fx' % (
+        t_legacy, peak_legacy/2**20, t_new, peak_new/2**20, t_legacy/t_new))
+    if not same:
+        sys.exit('transform_roc: the vectorized batch differs from the legacy loop')
+
+
+def legacy_adam(params, grads, lr, schedule, t_total, b1=0.9, b2=0.999, e=1e-8, l2=0, vector_l2=False,
+                max_grad_norm=-1):
+    """
+    original adam, the reference for opt.adam
+    """
+    import tensorflow as tf
+
+    t = tf.Variable(0, dtype=tf.float32, trainable=False)
+    tt = t+1
+    updates = [t.assign(tt)]
+    if max_grad_norm > 0:
+        grads, _ = tf.clip_by_global_norm(grads, max_grad_norm)
+    for p, g in zip(params, grads):
+        if isinstance(g, tf.IndexedSlices):
+            g = tf.convert_to_tensor(g)
+        m = tf.Variable(p*0, dtype=tf.float32, trainable=False)
+        v = tf.Variable(p*0, dtype=tf.float32, trainable=False)
+        lrt = lr*tf.sqrt(1-b2**tt)/(1-b1**tt)
+        lrt *= schedule(t/t_total)
+        mt = b1*m + (1-b1)*g
+        vt = b2*v + (1-b2)*g*g
+        if (len(p.get_shape()) > 1 or vector_l2) and l2 > 0:
+            pt = p - lrt * (mt / (tf.sqrt(vt) + e) + l2*p)
+        else:
+            pt = p - lrt * (mt / (tf.sqrt(vt) + e))
+        updates.extend([m.assign(mt), v.assign(vt), p.assign(pt)])
+    return tf.group(*updates)
+
+
+def flat_adam(shapes, initializers, loss_fn, **kwargs):
+    """
+    the flat-buffer layout: every param is a reshaped piece of one of two flat variables,
+    the decayed matrices and the undecayed vectors, and opt.adam updates the two buffers
+    returns (update op, params)
+    """
+    import tensorflow as tf
+    from opt import adam
+
+    sizes = [int(np.prod(shape)) for shape in shapes]
+    params = [None]*len(shapes)
+    buffers = []
+    for name, idx in [('matrices', [i for i, shape in enumerate(shapes) if len(shape) > 1]),
+                      ('vectors', [i for i, shape in enumerate(shapes) if len(shape) == 1])]:
+        buffer = tf.Variable(tf.concat([tf.reshape(initializers[i](shapes[i]), [-1]) for i in idx], 0), name=name)
+        for i, piece in zip(idx, tf.split(buffer, [sizes[i] for i in idx])):
+            params[i] = tf.reshape(piece, shapes[i])
+        buffers.append(buffer)
+    grads, _ = tf.clip_by_global_norm(tf.gradients(loss_fn(params), buffers), kwargs.pop('max_grad_norm'))
+    return tf.group(adam(buffers[:1], grads[:1], vector_l2=True, **kwargs),
+                    adam(buffers[1:], grads[1:], **kwargs)), params
+
+
+def bench_adam(args):
+    """
+    step time of opt.adam against the original on the shapes of an n_layer model, and of
+    params kept as pieces of flat buffers, the embedding gradient comes from a lookup
+    fails if the params drift apart
+    """
+    import tensorflow as tf
+    from functools import partial
+    from opt import adam, warmup_linear
+
+    n_embd = 768
+    block = [[1, n_embd, 3*n_embd], [3*n_embd], [1, n_embd, n_embd], [n_embd], [n_embd], [n_embd],
+             [1, n_embd, 4*n_embd], [4*n_embd], [1, 4*n_embd, n_embd], [n_embd], [n_embd], [n_embd]]
+    shapes = [[40478+3+512, n_embd]] + block*args.n_layer
+    initializers = [tf.random_normal_initializer(stddev=0.02, seed=i) for i in range(len(shapes))]
+    ids = np.random.RandomState(args.seed).randint(0, 40478, size=(args.n_batch, 2, 512)).astype(np.int32)
+
+    def loss_fn(params):
+        return 1e-2*(tf.reduce_sum(tf.sin(tf.gather(params[0], ids))) + tf.add_n([tf.reduce_sum(tf.sin(p))
+                                                                                 for p in params[1:]]))
+
+    def per_param(opt):
+        params = [tf.get_variable('p%d' % i, shape, initializer=init)
+                  for i, (shape, init) in enumerate(zip(shapes, initializers))]
+        return opt(params, tf.gradients(loss_fn(params), params), **kwargs), params
+
+    kwargs = dict(lr=6.25e-5, schedule=warmup_linear, t_total=1000, l2=0.01, max_grad_norm=1)
+    results = {}
+    for name, build in [('legacy', partial(per_param, legacy_adam)),
+                        ('adam', partial(per_param, partial(adam, lazy_sparse=False))),
+                        ('flat', partial(flat_adam, shapes, initializers, loss_fn, **dict(kwargs)))]:
+        tf.reset_default_graph()
+        train, params = build()
+        n_ops = len(tf.get_default_graph().get_operations())
+        sess = tf.Session()
+        sess.run(tf.global_variables_initializer())
+        sess.run(train)
+        t = time.time()
+        for _ in range(args.steps):
+            sess.run(train)
+        step_time = (time.time()-t)/args.steps
+        results[name] = sess.run(params)
+        sess.close()
+        print('%s: %.1fms/step, %d graph ops' % (name, step_time*1000, n_ops))
+    failed = []
+    for name in ['adam', 'flat']:
+        diff = max(float(np.abs(a-b).max()) for a, b in zip(results['legacy'], results[name]))
+        print('%s: max abs param difference to legacy after %d steps: %.2e' % (name, args.steps+1, diff))
+        if diff > 1e-6:
+            failed.append(name)
+    if failed:
+        sys.exit('adam: %s differ from the original adam' % ', '.join(failed))
+
+
+def bench_sparse_embd(args):
+    import tensorflow as tf
+    from opt import adam, warmup_linear
+
+    n_rows, n_embd = 40478+3+512, 768
+    rng = np.random.RandomState(args.seed)
+    ids = rng.randint(0, 40478, size=(args.n_batch, 2, 512)).astype(np.int32)
+    n_hit = len(np.unique(ids))
+    for lazy_sparse in [False, True]:
+        tf.reset_default_graph()
+        we = tf.get_variable('we', [n_rows, n_embd], initializer=tf.random_normal_initializer(stddev=0.02))
+        X = tf.placeholder(tf.int32, [None, 2, 512])
+        loss = tf.reduce_sum(tf.square(tf.gather(we, X)))
+        grads = tf.gradients(loss, [we])
+        train = adam([we], grads, 6.25e-5, warmup_linear, 1000, l2=0.01, lazy_sparse=lazy_sparse)
+        sess = tf.Session()
+        sess.run(tf.global_variables_initializer())
+        sess.run(train, {X: ids})
+        t = time.time()
+        for _ in range(args.steps):
+            sess.run(train, {X: ids})
+        step_time = (time.time()-t)/args.steps
+        sess.close()
+        # p, m and v are read and written, the gradient is read
+        rows = n_hit if lazy_sparse else n_rows
+        n_bytes = rows*n_embd*4*7
+        print('%s: %.1fms/step, %d rows updated, %.2fGB/step, %.1fGB/s' % (
+            'lazy sparse' if lazy_sparse else 'dense', step_time*1000, rows, n_bytes/2**30, n_bytes/2**30/step_time))
+
+
+def peak_bytes(run_metadata):
+    """
+    peak of the live bytes allocated by the ops of a FULL_TRACE session.run
+    replayed from the allocation records, feeds and variables are not counted
+    """
+    records = sorted((r.alloc_micros, r.alloc_bytes) for d in run_metadata.step_stats.dev_stats
+                     for n in d.node_stats for m in n.memory for r in m.allocation_records)
+    live = peak = 0
+    for _, n_bytes in records:
+        live += n_bytes
+        peak = max(peak, live)
+    return peak
+
+
+def model_params(args, **kwargs):
+    """
+    train.py defaults overridden by the bench arguments they share and kwargs
+    """
+    from train import get_parser, update_from_checkpoint
+
+    params = vars(get_parser().parse_args([]))
+    params.update(desc='bench_'+args.bench, dataset='rocstories', n_gpu=1, n_layer=args.n_layer,
+                  n_batch=args.n_batch, data_dir=args.data_dir, tokenizer=args.tokenizer,
+                  encoder_path=args.encoder_path, bpe_path=args.bpe_path)
+    if args.ckpt:
+        # the architecture a checkpoint was trained with is in its metadata
+        metadata = update_from_checkpoint(params, args.ckpt)
+        # data_prep shrinks n_ctx to fit the data, start from the one that gives the trained max_len
+        if 'max_len' in metadata:
+            params['n_ctx'] = 2*(metadata['max_len']+2)
+    params.update(kwargs)
+    return params
+
+
+def eval_model(params, ckpt=None):
+    """
+    train.Model with its ROCStories eval graph, weights from ckpt or the pretrained shards
+    """
+    import tensorflow as tf
+    from train import Model
+    from utils import find_trainable_variables
+
+    tf.reset_default_graph()
+    model = Model(params)
+    model.data_prep()
+    model.eval_logits, model.eval_clf_losses, _ = model.model(model.X, model.M, model.Y)
+    model.eval_clf_loss = tf.reduce_mean(model.eval_clf_losses)
+    model.eval_mgpu_logits, clf_losses, _ = model.mgpu_predict(model.X_train, model.M_train, model.Y_train)
+    model.eval_mgpu_clf_loss = tf.reduce_mean(clf_losses)
+    params = find_trainable_variables('model')
+    model.sess.run(tf.global_variables_initializer())
+    if ckpt:
+        model.restore(ckpt, params)
+    else:
+        model.load_pretrained(params)
+    return model
+
+
+def bench_precision(args):
+    import tensorflow as tf
+
+    ref = None
+    for precision in ['fp32', 'bf16', 'fp16']:
+        model = eval_model(model_params(args, precision=precision), args.ckpt)
+        t = time.time()
+        logits, cost = model.iter_apply(model.vaX, model.vaM, model.vaY, model.vaL)
+        elapsed = time.time()-t
+
+        # peak memory of the longest batch
+        idx = np.argsort(model.vaL)[-model.n_batch_train:]
+        xmb, mmb = model.batch(model.vaX, model.vaM, idx, model.vaL)
+        run_metadata = tf.RunMetadata()
+        model.sess.run(model.eval_mgpu_logits, {model.X_train: xmb, model.M_train: mmb},
+                       options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE), run_metadata=run_metadata)
+        model.sess.close()
+
+        if ref is None:
+            ref = logits
+        va_acc = 100.*np.mean(np.argmax(logits, 1) == model.vaY)
+        agree = 100.*np.mean(np.argmax(logits, 1) == np.argmax(ref, 1))
+        print('%s: va_acc %.2f va_cost %.4f  %.1f stories/s  peak %.1fMB  max |dlogit| %.2e  argmax agreement %.2f%%' % (
+            precision, va_acc, cost/model.n_valid, model.n_valid/elapsed, peak_bytes(run_metadata)/2**20,
+            float(np.abs(logits-ref).max()), agree))
+
+
+def legacy_attn(q, k, v):
+    """
+    original scaled dense attention with the band matrix mask, the reference for Model._attn
+    """
+    import tensorflow as tf
+    from utils import shape_list
+
+    w = tf.matmul(q, k) * tf.rsqrt(tf.cast(shape_list(v)[-1], tf.float32))
+    n = shape_list(w)[-1]
+    b = tf.matrix_band_part(tf.ones([n, n]), -1, 0)
+    b = tf.reshape(b, [1, 1, n, n])
+    w = w*b + -1e9*(1-b)
+    return tf.matmul(tf.nn.softmax(w), v)
+
+
+def bench_attn(args):
+    import tensorflow as tf
+    from train import Model
+
+    n_batch, n_head, n_state = 2*args.n_batch, 12, 64
+    rng = np.random.RandomState(args.seed)
+    for n_ctx in [128, 256, 384, 512]:
+        q, k, v = rng.randn(3, n_batch, n_head, n_ctx, n_state).astype(np.float32)
+        tf.reset_default_graph()
+        model = Model(model_params(args, n_ctx=n_ctx, attn_block=args.attn_block))
+        Q = tf.placeholder(tf.float32, [None, n_head, None, n_state])
+        K = tf.placeholder(tf.float32, [None, n_head, n_state, None])
+        V = tf.placeholder(tf.float32, [None, n_head, None, n_state])
+        outs = [('legacy', legacy_attn(Q, K, V)), ('dense', model._attn(Q, K, V, scale=True)),
+                ('blocked', model._blocked_attn(Q, K, V, scale=True))]
+        feed = {Q: q, K: k.transpose(0, 1, 3, 2), V: v}
+
+        ref = None
+        for name, out in outs:
+            run_metadata = tf.RunMetadata()
+            a = model.sess.run(out, feed, options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),
+                               run_metadata=run_metadata)
+            t = time.time()
+            for _ in range(args.steps):
+                model.sess.run(out, feed)
+            step_time = (time.time()-t)/args.steps
+            if ref is None:
+                ref = a
+            print('n_ctx %d %s: %.2fms  peak %.1fMB  max abs diff %.2e' % (
+                n_ctx, name, step_time*1000, peak_bytes(run_metadata)/2**20, float(np.abs(a-ref).max())))
+        model.sess.close()
+
+
+def bench_recompute(args):
+    import tensorflow as tf
+    from train import Model
+
+    n_ctx = 512
+    rng = np.random.RandomState(args.seed)
+    X = rng.randint(0, 40478, size=(args.n_batch, 2, n_ctx, 2)).astype(np.int32)
+    X[:, :, :, 1] = np.arange(40478+3, 40478+3+n_ctx)
+    M = np.ones((args.n_batch, 2, n_ctx), dtype=np.float32)
+    Y = rng.randint(0, 2, size=args.n_batch).astype(np.int32)
+    ref = None
+    for k in args.recompute:
+        tf.reset_default_graph()
+        model = Model(model_params(args, n_ctx=n_ctx, recompute=k, embd_pdrop=0, attn_pdrop=0, resid_pdrop=0, clf_pdrop=0))
+        model.n_vocab, model.clf_token = 40478, 40478+2
+        Xs = tf.placeholder(tf.int32, [None, 2, None, 2])
+        Ms = tf.placeholder(tf.float32, [None, 2, None])
+        Ys = tf.placeholder(tf.int32, [None])
+        _, clf_losses, lm_losses = model.model(Xs, Ms, Ys, train=True)
+        loss = tf.reduce_mean(clf_losses) + model.params["lm_coef"] * tf.reduce_mean(lm_losses)
+        params = tf.trainable_variables()
+        grads = model.recompute_gradients(loss, params) if k else tf.gradients(loss, params)
+        grads = [tf.convert_to_tensor(g) for g in grads]
+        model.sess.run(tf.global_variables_initializer())
+        # every graph starts from the first one's weights
+        if ref is None:
+            weights = model.sess.run(params)
+        for p, w in zip(params, weights):
+            p.load(w, model.sess)
+        feed = {Xs: X, Ms: M, Ys: Y}
+
+        run_metadata = tf.RunMetadata()
+        g = model.sess.run(grads, feed, options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),
+                           run_metadata=run_metadata)
+        t = time.time()
+        for _ in range(args.steps):
+            model.sess.run(grads, feed)
+        step_time = (time.time()-t)/args.steps
+        model.sess.close()
+        if ref is None:
+            ref = g
+        diff = max(float(np.abs(a-b).max()/(np.abs(b).max()+1e-12)) for a, b in zip(g, ref))
+        print('recompute %d: %.2fs/step  peak %.1fMB  max rel grad diff %.2e' % (
+            k, step_time, peak_bytes(run_metadata)/2**20, diff))
+
+
+def bench_generate(args):
+    import tensorflow as tf
+    from train import Model
+
+    rng = np.random.RandomState(args.seed)
+    n_vocab, n_context = 40478, 64
+    tf.reset_default_graph()
+    model = Model(model_params(args, n_ctx=512))
+    model.n_vocab = n_vocab
+    context = np.stack([rng.randint(0, n_vocab, size=n_context), n_vocab+3+np.arange(n_context)], 1)
+    context = np.repeat(context[None].astype(np.int32), args.n_batch, 0)
+    X = tf.placeholder(tf.int32, [None, None, 2])
+    outs = {}
+    for n_tokens in [32, 128]:
+        for cache in [False, True]:
+            outs[n_tokens, cache] = model.generate(X, n_tokens, cache=cache)
+    model.sess.run(tf.global_variables_initializer())
+    for n_tokens in [32, 128]:
+        tokens = {}
+        for cache in [False, True]:
+            model.sess.run(outs[n_tokens, cache], {X: context})
+            t = time.time()
+            tokens[cache] = model.sess.run(outs[n_tokens, cache], {X: context})
+            elapsed = time.time()-t
+            print('%d tokens after %d, batch %d, %s: %.1f tokens/s' % (
+                n_tokens, n_context, args.n_batch, 'kv cache' if cache else 'recompute', tokens[cache].size/elapsed))
+        print('greedy outputs identical: %s' % np.array_equal(tokens[False], tokens[True]))
+
+
+def bench_frozen(args):
+    import tempfile
+    import tensorflow as tf
+    from serve import Classifier
+    from export import export_classifier
+
+    if args.ckpt is None:
+        sys.exit('frozen: --ckpt is required, the export needs a fine-tuned checkpoint')
+    st, ct1, ct2, _ = _rocstories(os.path.join(args.data_dir, 'cloze_test_val__spring2016 - cloze_test_ALL_val.csv'))
+    requests = list(zip(st, ct1, ct2))[:args.n_batch]
+    path = os.path.join(tempfile.mkdtemp(), 'clf.pb')
+    tf.reset_default_graph()
+    t = time.time()
+    export_classifier(model_params(args), args.ckpt, path)
+    print('export: %.2fs, %.1fMB' % (time.time()-t, os.path.getsize(path)/2**20))
+
+    results = {}
+    for source in ['ckpt', 'graph']:
+        tf.reset_default_graph()
+        t = time.time()
+        classifier = Classifier(model_params(args), **{source: args.ckpt if source == 'ckpt' else path})
+        classifier(requests)
+        t_cold = time.time()-t
+        t = time.time()
+        for _ in range(args.steps):
+            results[source] = classifier(requests)
+        step_time = (time.time()-t)/args.steps
+        n_ops = len(tf.get_default_graph().get_operations())
+        classifier.model.sess.close()
+        print('%s: cold start %.2fs  %.1fms per batch of %d  %d graph ops' % (
+            source, t_cold, step_time*1000, len(requests), n_ops))
+    diff = max(abs(a - b) for ra, rb in zip(results['ckpt'], results['graph'])
+               for a, b in zip(ra['logits'], rb['logits']))
+    print('max abs logit difference %.2e' % diff)
+
+
+def bench_choice(args):
+    import tensorflow as tf
+    from serve import Classifier
+
+    if args.ckpt is None:
+        sys.exit('choice: --ckpt is required, the classifier needs a fine-tuned checkpoint')
+    st, ct1, ct2, _ = _rocstories(os.path.join(args.data_dir, 'cloze_test_val__spring2016 - cloze_test_ALL_val.csv'))
+    requests = list(zip(st, ct1, ct2))[:args.n_batch]
+    results = {}
+    for shared_prefix in [False, True]:
+        tf.reset_default_graph()
+        classifier = Classifier(model_params(args), ckpt=args.ckpt, shared_prefix=shared_prefix)
+        classifier(requests)
+        t = time.time()
+        for _ in range(args.steps):
+            results[shared_prefix] = classifier(requests)
+        step_time = (time.time()-t)/args.steps
+        classifier.model.sess.close()
+        print('%s: %.1fms per batch of %d' % ('shared prefix' if shared_prefix else 'full sequences',
+                                             step_time*1000, len(requests)))
+    # positions each path runs through the blocks, before padding
+    x1, x2, x3 = (classifier.text_encoder.encode(texts, verbose=False) for texts in zip(*requests))
+    l1, l2, l3 = (np.minimum([len(x) for x in xs], classifier.model.max_len) for xs in [x1, x2, x3])
+    print('positions: %d full, %d shared prefix' % ((2*l1 + l2 + l3 + 6).sum(), (l1 + l2 + l3 + 4).sum()))
+    diff = max(abs(a - b) for ra, rb in zip(results[False], results[True])
+               for a, b in zip(ra['logits'], rb['logits']))
+    same = np.mean([ra['prediction'] == rb['prediction'] for ra, rb in zip(results[False], results[True])])
+    print('max abs logit difference %.2e, predictions agree on %.1f%%' % (diff, same*100))
+
+
+def bench_lm_loss(args):
+    import tensorflow as tf
+    from train import Model
+    from utils import find_trainable_variables
+
+    rng = np.random.RandomState(args.seed)
+    batches = None
+    for mode in ['full', 'masked', 'sampled']:
+        tf.reset_default_graph()
+        model = Model(model_params(args, lm_loss=mode, embd_pdrop=0, attn_pdrop=0, resid_pdrop=0, clf_pdrop=0))
+        model.data_prep()
+        if batches is None:
+            # one unbucketed and one length-bucketed batch of training stories
+            batches = [rng.choice(model.n_train, args.n_batch, replace=False),
+                       np.argsort(model.trL)[-args.n_batch:]]
+            batches = [model.batch(model.trX, model.trM, idx, model.trL) + (model.trY[idx],) for idx in batches]
+        _, clf_losses, lm_losses = model.model(model.X, model.M, model.Y, train=True)
+        lm_loss = tf.reduce_mean(lm_losses)
+        loss = tf.reduce_mean(clf_losses) + model.params["lm_coef"] * lm_loss
+        params = find_trainable_variables('model')
+        grads = [tf.convert_to_tensor(g) for g in tf.gradients(loss, params)]
+        eval_lm_loss = tf.reduce_mean(model.model(model.X, model.M, model.Y, reuse=True)[2])
+        model.sess.run(tf.global_variables_initializer())
+        if args.ckpt:
+            model.restore(args.ckpt, params)
+        else:
+            model.load_pretrained(params)
+
+        for name, (xmb, mmb, ymb) in zip(['random', 'bucketed'], batches):
+            feed = {model.X: xmb, model.M: mmb, model.Y: ymb}
+            run_metadata = tf.RunMetadata()
+            model.sess.run(grads, feed, options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),
+                           run_metadata=run_metadata)
+            t = time.time()
+            for _ in range(args.steps):
+                model.sess.run(grads, feed)
+            step_time = (time.time()-t)/args.steps
+            train_loss, eval_loss = model.sess.run([lm_loss, eval_lm_loss], feed)
+            print('%s %s batch (%.0f%% padding): %.1fms/step  peak %.1fMB  lm loss train %.6f eval %.6f' % (
+                mode, name, 100*(1-mmb.mean()), step_time*1000, peak_bytes(run_metadata)/2**20,
+                train_loss, eval_loss))
+        model.sess.close()
+
+
+benches = {
+    'bpe': bench_bpe,
+    'pretok': bench_pretok,
+    'standardize': bench_standardize,
+    'transform_roc': bench_transform_roc,
+    'adam': bench_adam,
+    'sparse_embd': bench_sparse_embd,
+    'precision': bench_precision,
+    'attn': bench_attn,
+    'recompute': bench_recompute,
+    'generate': bench_generate,
+    'frozen': bench_frozen,
+    'choice': bench_choice,
+    'lm_loss': bench_lm_loss,
+}
+
+# transform_roc is measured at the size of the full ROCStories training corpus
+n_defaults = {
+    'transform_roc': 100000,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('bench', type=str, choices=sorted(benches))
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--n', type=int, default=None)
+    parser.add_argument('--data_dir', type=str, default='data/')
+    parser.add_argument('--steps', type=int, default=20)
+    parser.add_argument('--n_layer', type=int, default=12)
+    parser.add_argument('--n_batch', type=int, default=8)
+    parser.add_argument('--encoder_path', type=str, default='model/encoder_bpe_40000.json')
+    parser.add_argument('--bpe_path', type=str, default='model/vocab_40000.bpe')
+    parser.add_argument('--tokenizer', type=str, default='spacy', choices=['spacy', 'regex'])
+    parser.add_argument('--ckpt', type=str, default=None)
+    parser.add_argument('--attn_block', type=int, default=64)
+    parser.add_argument('--recompute', type=int, nargs='+', default=[0, 1, 2])
+    parser.add_argument('--min_agreement', type=float, default=97.)
+
+    args = parser.parse_args()
+    if args.n is None:
+        args.n = n_defaults.get(args.bench, 20000)
+    benches[args.bench](args)
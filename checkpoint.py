@@ -0,0 +1,142 @@
+import os
+import json
+import shutil
+import struct
+import threading
+import numpy as np
+
+from contextlib import contextmanager
+from collections import OrderedDict
+
+ALIGN = 64
+
+def _aligned(offset):
+    return (offset + ALIGN - 1) // ALIGN * ALIGN
+
+def _fsync(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _remove(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+@contextmanager
+def atomic_path(path):
+    """
+    yields a temporary path next to path to write a file or a directory of files to
+    once the block exits the data is synced to disk and renamed over path,
+    if it raises the temporary is removed and path is left as it was
+    """
+    path = path.rstrip('/')
+    d = os.path.dirname(path)
+    if d:
+        os.makedirs(d, exist_ok=True)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    _remove(tmp_path)
+    try:
+        yield tmp_path
+        if os.path.isdir(tmp_path):
+            for name in os.listdir(tmp_path):
+                _fsync(os.path.join(tmp_path, name))
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+        _fsync(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        _remove(tmp_path)
+        raise
+    _fsync(d or '.')
+
+def save_checkpoint(path, tensors, dtype=None, metadata=None):
+    """
+    single file checkpoint: 8 byte little endian header size, json header, raw buffer
+    the header maps each name to dtype, shape and [begin, end) byte offsets into the buffer
+    tensors start on ALIGN byte boundaries so they can be memory-mapped in place
+    floating point tensors are stored as dtype when given (e.g. float16)
+    the file is written next to path and renamed into place with atomic_path
+    """
+    header = OrderedDict()
+    if metadata is not None:
+        header['__metadata__'] = metadata
+    arrays = []
+    offset = 0
+    for name, value in tensors:
+        value = np.asarray(value)
+        if not value.flags.c_contiguous:
+            value = value.copy()
+        if dtype is not None and value.dtype.kind == 'f':
+            value = value.astype(dtype)
+        offset = _aligned(offset)
+        header[name] = {'dtype': value.dtype.name,
+                        'shape': list(value.shape),
+                        'offsets': [offset, offset + value.nbytes]}
+        arrays.append((offset, value))
+        offset += value.nbytes
+    header = json.dumps(header).encode('utf-8')
+    header += b' ' * (_aligned(8 + len(header)) - 8 - len(header))
+
+    with atomic_path(path) as tmp_path, open(tmp_path, 'wb') as f:
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        start = f.tell()
+        for offset, value in arrays:
+            f.write(b'\0' * (start + offset - f.tell()))
+            f.write(value.tobytes())
+
+def read_header(path):
+    with open(path, 'rb') as f:
+        n = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(n).decode('utf-8'), object_pairs_hook=OrderedDict)
+    return n, header
+
+def load_checkpoint(path):
+    """
+    returns (tensors, metadata), tensors is an ordered name -> array mapping
+    the arrays are read-only views into a memory map of the file
+    """
+    n, header = read_header(path)
+    metadata = header.pop('__metadata__', None)
+    if not header:
+        return OrderedDict(), metadata
+    buf = np.memmap(path, dtype=np.uint8, mode='r', offset=8 + n)
+    tensors = OrderedDict()
+    for name, info in header.items():
+        begin, end = info['offsets']
+        tensors[name] = buf[begin:end].view(info['dtype']).reshape(info['shape'])
+    return tensors, metadata
+
+class AsyncSaver(object):
+    """
+    writes checkpoints on a background thread, one at a time
+    a new save waits for the previous one, errors surface on the next save or join
+    """
+
+    def __init__(self):
+        self.thread = None
+        self.error = None
+
+    def _run(self, *args, **kwargs):
+        try:
+            save_checkpoint(*args, **kwargs)
+        except Exception as e:
+            self.error = e
+
+    def save(self, path, tensors, dtype=None, metadata=None):
+        self.join()
+        self.thread = threading.Thread(target=self._run, args=(path, tensors),
+                                       kwargs={'dtype': dtype, 'metadata': metadata})
+        self.thread.start()
+
+    def join(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
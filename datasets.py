@@ -27,9 +27,14 @@ def _rocstories(path):
                 y.append(int(line[-1])-1)
         return st, ct1, ct2, y
 
+def rocstories_paths(data_dir):
+    return [os.path.join(data_dir, 'cloze_test_val__spring2016 - cloze_test_ALL_val.csv'),
+            os.path.join(data_dir, 'cloze_test_test__spring2016 - cloze_test_ALL_test.csv')]
+
 def rocstories(data_dir, n_train=1497, n_valid=374):
-    storys, comps1, comps2, ys = _rocstories(os.path.join(data_dir, 'cloze_test_val__spring2016 - cloze_test_ALL_val.csv'))
-    teX1, teX2, teX3, _ = _rocstories(os.path.join(data_dir, 'cloze_test_test__spring2016 - cloze_test_ALL_test.csv'))
+    val_path, test_path = rocstories_paths(data_dir)
+    storys, comps1, comps2, ys = _rocstories(val_path)
+    teX1, teX2, teX3, _ = _rocstories(test_path)
     tr_storys, va_storys, tr_comps1, va_comps1, tr_comps2, va_comps2, tr_ys, va_ys = train_test_split(storys, comps1, comps2, ys, test_size=n_valid, random_state=seed)
     trX1, trX2, trX3 = [], [], []
     trY = []
@@ -0,0 +1,97 @@
+import json
+import time
+import tensorflow as tf
+
+from tensorflow.python.grappler import tf_optimizer
+from tensorflow.python.tools import optimize_for_inference_lib
+
+from train import Model, get_parser, update_from_checkpoint
+from quantize import quantized_scope
+from utils import find_trainable_variables
+
+METADATA_KEYS = ['n_ctx', 'n_embd', 'n_head', 'n_layer', 'afn', 'max_len', 'n_vocab', 'n_special',
+                 'encoder_path', 'bpe_path', 'tokenizer']
+
+
+def export_classifier(params, ckpt, path):
+    """
+    writes the classification path of a fine-tuned checkpoint as one frozen GraphDef
+    input X [batch, 2, n, 2] int32, output clf_logits [batch, 2], the mask only feeds the lm loss
+    variables are folded to constants, there is no lm head and no dropout, and the
+    checkpoint metadata is kept as the json string constant 'metadata'
+    grappler runs here once, so load it into a session from frozen_session
+    """
+    metadata = update_from_checkpoint(params, ckpt)
+    graph = tf.Graph()
+    with graph.as_default():
+        model = Model(params)
+        model.setup_encoder(json.load(open(params["encoder_path"])))
+        X = tf.placeholder(tf.int32, [None, 2, None, 2], name='X')
+        with quantized_scope(metadata):
+            logits = model.model(X, tf.placeholder(tf.float32, [None, 2, None]), lm_head=False)[0]
+        tf.identity(logits, name='clf_logits')
+        tf.constant(json.dumps({k: metadata.get(k) for k in METADATA_KEYS}), name='metadata')
+        model.sess.run(tf.global_variables_initializer())
+        model.restore(ckpt, find_trainable_variables('model'))
+
+        outputs = ['clf_logits', 'metadata']
+        graph_def = tf.graph_util.convert_variables_to_constants(model.sess, graph.as_graph_def(), outputs)
+        model.sess.close()
+    graph_def = optimize_for_inference_lib.optimize_for_inference(graph_def, ['X'], outputs,
+                                                                  [tf.int32.as_datatype_enum])
+    graph_def = optimize(graph_def, outputs)
+    with open(path, 'wb') as f:
+        f.write(graph_def.SerializeToString())
+    return graph_def
+
+
+def optimize(graph_def, outputs):
+    """
+    graph_def as rewritten by grappler for the cpu, with the outputs kept by name
+    left to the session, grappler would refold the weight constants on every start
+    """
+    with tf.Graph().as_default() as graph:
+        with tf.device('/cpu:0'):
+            tf.import_graph_def(graph_def, name='')
+        for name in outputs:
+            graph.add_to_collection('train_op', graph.get_operation_by_name(name))
+        meta_graph = tf.train.export_meta_graph(graph=graph)
+    graph_def = tf_optimizer.OptimizeGraph(tf.ConfigProto(), meta_graph)
+    for node in graph_def.node:
+        node.device = ''
+    return graph_def
+
+
+def frozen_session():
+    """
+    a session for graphs written by export_classifier, which were optimized at export time
+    """
+    config = tf.ConfigProto(allow_soft_placement=True)
+    config.graph_options.rewrite_options.disable_meta_optimizer = True
+    return tf.Session(config=config)
+
+
+def load_frozen(path):
+    """
+    returns (graph_def, metadata) of a graph written by export_classifier
+    """
+    graph_def = tf.GraphDef()
+    with open(path, 'rb') as f:
+        graph_def.ParseFromString(f.read())
+    node = next(node for node in graph_def.node if node.name == 'metadata')
+    metadata = json.loads(tf.make_ndarray(node.attr['value'].tensor).item().decode('utf-8'))
+    return graph_def, metadata
+
+
+if __name__ == '__main__':
+    parser = get_parser()
+    parser.add_argument('--ckpt', type=str, required=True)
+    parser.add_argument('--out', type=str, required=True)
+    parser.set_defaults(desc='export')
+
+    args = parser.parse_args()
+    t = time.time()
+    graph_def = export_classifier(args.__dict__, args.ckpt, args.out)
+    n_bytes = sum(node.attr['value'].tensor.ByteSize() for node in graph_def.node if node.op == 'Const')
+    print('wrote %s: %d nodes, %.1fMB of constants in %.2fs' % (args.out, len(graph_def.node), n_bytes/2**20,
+                                                                time.time()-t))
@@ -0,0 +1,56 @@
+import time
+import numpy as np
+import tensorflow as tf
+
+from train import Model, get_parser, update_from_checkpoint
+from text_utils import TextEncoder
+from quantize import quantized_scope
+from utils import find_trainable_variables
+
+
+if __name__ == '__main__':
+    parser = get_parser()
+    parser.add_argument('--ckpt', type=str, default=None)
+    parser.add_argument('--context', type=str, required=True)
+    parser.add_argument('--n_tokens', type=int, default=32)
+    parser.add_argument('--n_samples', type=int, default=1)
+    parser.add_argument('--top_k', type=int, default=1)
+    parser.add_argument('--temperature', type=float, default=1.)
+    parser.add_argument('--no_cache', action='store_true')
+    parser.set_defaults(desc='generate')
+
+    args = parser.parse_args()
+    params = args.__dict__
+    metadata = {}
+    if args.ckpt:
+        metadata = update_from_checkpoint(params, args.ckpt)
+    if not 0 < args.n_tokens < params["n_ctx"]:
+        parser.error('--n_tokens must be between 1 and n_ctx-1 (%d)' % (params["n_ctx"]-1))
+
+    text_encoder = TextEncoder(args.encoder_path, args.bpe_path, tokenizer=args.tokenizer)
+    m = Model(params)
+    m.n_vocab = len(text_encoder.encoder)
+
+    context = text_encoder.encode([args.context], verbose=False)[0][-(m.params["n_ctx"]-args.n_tokens):]
+    if not context:
+        parser.error('--context must encode to at least one token')
+    X = tf.placeholder(tf.int32, [None, None, 2])
+    with quantized_scope(metadata):
+        tokens = m.generate(X, args.n_tokens, top_k=args.top_k, temperature=args.temperature,
+                            cache=not args.no_cache)
+
+    model_params = find_trainable_variables('model')
+    m.sess.run(tf.global_variables_initializer())
+    if args.ckpt:
+        m.restore(args.ckpt, model_params)
+    else:
+        m.load_pretrained(model_params)
+
+    x = np.stack([context, m.n_vocab + m.n_special + np.arange(len(context))], 1)
+    x = np.repeat(x[None], args.n_samples, 0)
+    t = time.time()
+    samples = m.sess.run(tokens, {X: x})
+    elapsed = time.time()-t
+    for sample in samples:
+        print(text_encoder.decode(sample.tolist()))
+    print('%d tokens in %.2fs, %.1f tokens/s' % (samples.size, elapsed, samples.size/elapsed))
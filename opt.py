@@ -20,30 +20,70 @@ schedules = {
     'warmup_linear':warmup_linear,
 }
 
-def adam(params, grads, lr, schedule, t_total, b1=0.9, b2=0.999, e=1e-8, l2=0, vector_l2=False, max_grad_norm=-1, **kwargs):
+def lazy_adam_update(p, g, lrt, b1, b2, e, l2=0):
+    """
+    adam update touching only the rows of p, m and v that appear in the IndexedSlices g
+    rows that are not hit keep stale moments instead of decaying them
+    """
+    m = tf.Variable(p*0, dtype=tf.float32, trainable=False)
+    v = tf.Variable(p*0, dtype=tf.float32, trainable=False)
+    idx, seg = tf.unique(g.indices)
+    g = tf.unsorted_segment_sum(g.values, seg, tf.shape(idx)[0])
+    mt = b1*tf.gather(m, idx) + (1-b1)*g
+    vt = b2*tf.gather(v, idx) + (1-b2)*g*g
+    u = mt / (tf.sqrt(vt) + e)
+    if l2 > 0:
+        u += l2*tf.gather(p, idx)
+    return [tf.scatter_update(m, idx, mt), tf.scatter_update(v, idx, vt), tf.scatter_sub(p, idx, lrt*u)]
+
+def sparse_moments(m, v, g, b1, b2):
+    """
+    the dense adam moment update for an IndexedSlices gradient g without making g dense
+    m and v decay everywhere and the gradient is only added to the rows it hits
+    """
+    idx, seg = tf.unique(g.indices)
+    g = tf.unsorted_segment_sum(g.values, seg, tf.shape(idx)[0])
+    with tf.control_dependencies([m.assign(b1*m), v.assign(b2*v)]):
+        return tf.scatter_add(m, idx, (1-b1)*g), tf.scatter_add(v, idx, (1-b2)*g*g)
+
+def adam(params, grads, lr, schedule, t_total, b1=0.9, b2=0.999, e=1e-8, l2=0, vector_l2=False, max_grad_norm=-1,
+         lazy_sparse=False, **kwargs):
     """
     adam with weight decay fix
+    the bias corrected and scheduled learning rate is computed once for all params
+    IndexedSlices gradients stay sparse, with lazy_sparse they only update the rows they hit
     """
     t = tf.Variable(0, dtype=tf.float32, trainable=False)
     tt = t+1
     updates = [t.assign(tt)]
     if max_grad_norm > 0:
         grads, _ = tf.clip_by_global_norm(grads, max_grad_norm)
+    lrt = lr*tf.sqrt(1-b2**tt)/(1-b1**tt)
+    lrt *= schedule(t/t_total)
     for p, g in zip(params, grads):
         if p is None or g is None:
             print("can't train", p.name, g)
+            continue
+        decay = (len(p.get_shape()) > 1 or vector_l2) and l2 > 0
+        if isinstance(g, tf.IndexedSlices) and lazy_sparse:
+            updates.extend(lazy_adam_update(p, g, lrt, b1, b2, e, l2 if decay else 0))
+            continue
+        m = tf.Variable(p*0, dtype=tf.float32, trainable=False)
+        v = tf.Variable(p*0, dtype=tf.float32, trainable=False)
+        if isinstance(g, tf.IndexedSlices):
+            mt, vt = sparse_moments(m, v, g, b1, b2)
+            updates.extend([mt, vt])
         else:
-            if isinstance(g, tf.IndexedSlices):
-                g = tf.convert_to_tensor(g)
-            m = tf.Variable(p*0, dtype=tf.float32, trainable=False)
-            v = tf.Variable(p*0, dtype=tf.float32, trainable=False)
-            lrt = lr*tf.sqrt(1-b2**tt)/(1-b1**tt)
-            lrt *= schedule(t/t_total)
             mt = b1*m + (1-b1)*g
             vt = b2*v + (1-b2)*g*g
-            if (len(p.get_shape()) > 1 or vector_l2) and l2 > 0:
-                pt = p - lrt * (mt / (tf.sqrt(vt) + e) + l2*p)
-            else:
-                pt = p - lrt * (mt / (tf.sqrt(vt) + e))
-            updates.extend([m.assign(mt), v.assign(vt), p.assign(pt)])
+            updates.extend([m.assign(mt), v.assign(vt)])
+        if decay:
+            pt = p - lrt * (mt / (tf.sqrt(vt) + e) + l2*p)
+        else:
+            pt = p - lrt * (mt / (tf.sqrt(vt) + e))
+        updates.append(p.assign(pt))
     return tf.group(*updates)
+
+opts = {
+    'adam':adam,
+}
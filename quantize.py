@@ -0,0 +1,188 @@
+import os
+import re
+import json
+import time
+import joblib
+import numpy as np
+import tensorflow as tf
+
+from collections import OrderedDict
+
+from train import Model, get_parser
+from checkpoint import save_checkpoint, load_checkpoint, read_header
+from datasets import rocstories
+from utils import find_trainable_variables
+
+QUANTIZED = re.compile(r'model/(we|h\d+/.*/w)(:0)?$')
+
+
+def quantized(name):
+    """
+    the embedding and the conv1d weights of the blocks are stored as int8,
+    biases, norm gains and the classifier head stay float32
+    """
+    return QUANTIZED.match(name) is not None
+
+
+def channel_axis(name):
+    # embedding rows are looked up and scored one token at a time, conv1d weights per output channel
+    return 0 if name.startswith('model/we') else -1
+
+
+def scale_name(name):
+    return name[:-2] + '/scale:0' if name.endswith(':0') else name + '/scale'
+
+
+def quantize(w, axis):
+    """
+    symmetric per-channel int8, returns (q, scale) with w ~= q * scale
+    scale keeps the dims of w with size 1 everywhere but axis
+    """
+    axes = tuple(i for i in range(w.ndim) if i != axis % w.ndim)
+    scale = np.abs(w).max(axis=axes, keepdims=True) / 127.
+    scale[scale == 0] = 1.
+    q = np.clip(np.round(w / scale), -127, 127).astype(np.int8)
+    return q, scale.astype(np.float32)
+
+
+def int8_getter(getter, name, *args, **kwargs):
+    """
+    custom getter that keeps quantized weights as int8 variables next to their
+    float32 scales and hands the model the dequantized product
+    per-row weights are also registered for utils.gather_rows, so lookups only
+    dequantize the rows they read and the full product runs only for the lm heads
+    """
+    if not quantized(name):
+        return getter(name, *args, **kwargs)
+    shape = kwargs['shape']
+    axis = channel_axis(name) % len(shape)
+    kwargs.update(dtype=tf.int8, initializer=tf.zeros_initializer())
+    q = getter(name, *args, **kwargs)
+    kwargs.update(shape=[n if i == axis else 1 for i, n in enumerate(shape)], dtype=tf.float32,
+                  initializer=tf.ones_initializer())
+    scale = getter(scale_name(name), *args, **kwargs)
+    # outside of any while loop, so that generate dequantizes once per run rather than per token
+    with tf.control_dependencies(None):
+        w = tf.cast(q, tf.float32) * scale
+    if axis == 0:
+        tf.add_to_collection('int8_rows', (w, q, scale))
+    return w
+
+
+def int8_row_reads(graph):
+    """
+    (ops reading a full dequantized matrix, lookups reading int8 rows) of the per-row
+    quantized weights in graph, a classifier only looks up rows so the first should be 0
+    """
+    n_full, n_rows = 0, 0
+    for w, q, _ in graph.get_collection('int8_rows'):
+        n_full += len(w.consumers())
+        n_rows += sum(op.type in ('Gather', 'GatherV2', 'ResourceGather') for op in q.value().consumers())
+    return n_full, n_rows
+
+
+def quantized_scope(metadata):
+    """
+    variable scope to build a model in before restoring the checkpoint metadata came from
+    """
+    getter = int8_getter if metadata.get('quantized') == 'int8' else None
+    return tf.variable_scope(tf.get_variable_scope(), custom_getter=getter)
+
+
+def load_params(path, params):
+    """
+    (tensors, metadata) of a checkpoint, or of a legacy best_params.jl, a joblib list of
+    arrays in find_trainable_variables order whose names and shapes come from rebuilding the model
+    the embedding only holds the n_ctx data_prep shrank to, max_len follows the --n_ctx trained with
+    """
+    if not path.endswith('.jl'):
+        return load_checkpoint(path)
+    values = joblib.load(path)
+    params = dict(params, n_layer=(len(values)-3)//12, n_embd=values[0].shape[1])
+    max_len = params["n_ctx"]//2-2
+    with tf.Graph().as_default():
+        model = Model(params)
+        model.setup_encoder(json.load(open(params["encoder_path"])))
+        params["n_ctx"] = values[0].shape[0] - model.n_vocab - model.n_special
+        model.model(tf.placeholder(tf.int32, [None, 2, None, 2]), tf.placeholder(tf.float32, [None, 2, None]))
+        names = [p.name for p in find_trainable_variables('model')]
+        model.sess.close()
+    metadata = {k: params[k] for k in ['n_ctx', 'n_embd', 'n_head', 'n_layer', 'afn', 'encoder_path', 'bpe_path',
+                                       'tokenizer']}
+    metadata.update(n_vocab=model.n_vocab, n_special=model.n_special, max_len=max_len)
+    return OrderedDict(zip(names, values)), metadata
+
+
+def quantize_checkpoint(tensors, metadata, path):
+    """
+    writes tensors with every quantized weight replaced by its int8 values and scales
+    """
+    out = []
+    for name, value in tensors.items():
+        value = np.asarray(value, dtype=np.float32)
+        if quantized(name):
+            q, scale = quantize(value, channel_axis(name))
+            out += [(name, q), (scale_name(name), scale)]
+        else:
+            out.append((name, value))
+    save_checkpoint(path, out, metadata=dict(metadata, quantized='int8'))
+    return out
+
+
+def evaluate(params, ckpt, X1, X2, X3, Y, n_batch):
+    """
+    ROCStories accuracy and seconds per batch of the serving classifier
+    fails if an int8 embedding is dequantized in full rather than looked up as int8 rows
+    """
+    from serve import Classifier
+
+    tf.reset_default_graph()
+    classifier = Classifier(dict(params), ckpt=ckpt)
+    n_full, n_rows = int8_row_reads(tf.get_default_graph())
+    if n_full or (read_header(ckpt)[1]['__metadata__'].get('quantized') == 'int8' and not n_rows):
+        raise RuntimeError('%s: %d ops read the dequantized embedding, %d lookups read its int8 rows'
+                           % (ckpt, n_full, n_rows))
+    requests = list(zip(X1, X2, X3))
+    classifier(requests[:n_batch])
+    predictions = []
+    t = time.time()
+    for i in range(0, len(requests), n_batch):
+        predictions += [r['prediction'] for r in classifier(requests[i:i+n_batch])]
+    elapsed = time.time()-t
+    classifier.model.sess.close()
+    return np.mean(np.asarray(predictions) == Y)*100, elapsed/((len(requests)+n_batch-1)//n_batch)
+
+
+if __name__ == '__main__':
+    parser = get_parser()
+    parser.add_argument('--ckpt', type=str, required=True)
+    parser.add_argument('--out', type=str, required=True)
+    parser.add_argument('--eval', action='store_true')
+    parser.set_defaults(desc='quantize')
+
+    args = parser.parse_args()
+    params = args.__dict__
+    tensors, metadata = load_params(args.ckpt, params)
+    out = quantize_checkpoint(tensors, metadata, args.out)
+    n_float = sum(np.asarray(value).size*4 for value in tensors.values())
+    n_int8 = sum(value.nbytes for _, value in out)
+    print('weights %.1fMB -> %.1fMB, file %.1fMB' % (n_float/2**20, n_int8/2**20, os.path.getsize(args.out)/2**20))
+    out = dict(out)
+    errors = [np.abs(out[name]*out[scale_name(name)] - value).max()/np.abs(value).max()
+              for name, value in tensors.items() if quantized(name)]
+    print('max weight error %.2e relative to the largest weight of its tensor' % max(errors))
+
+    if args.eval:
+        _, (vaX1, vaX2, vaX3, vaY), _ = rocstories(args.data_dir)
+        if args.ckpt.endswith('.jl'):
+            # the serving classifier reads checkpoints, the float32 reference is written as one
+            reference = args.out + '.fp32'
+            save_checkpoint(reference, list(tensors.items()), metadata=metadata)
+        else:
+            reference = args.ckpt
+        accuracy = {}
+        for name, ckpt in [('fp32', reference), ('int8', args.out)]:
+            accuracy[name], step_time = evaluate(params, ckpt, vaX1, vaX2, vaX3, vaY, args.n_batch)
+            print('%s: valid accuracy %.2f  %.1fms per batch of %d' % (name, accuracy[name], step_time*1000,
+                                                                       args.n_batch))
+        print('accuracy delta %+.2f' % (accuracy['int8'] - accuracy['fp32']))
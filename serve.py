@@ -0,0 +1,265 @@
+import sys
+import json
+import time
+import queue
+import threading
+import numpy as np
+import tensorflow as tf
+
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from train import Model, get_parser, update_architecture, update_from_checkpoint
+from text_utils import TextEncoder
+from export import load_frozen, frozen_session
+from quantize import quantized_scope
+from utils import ragged, find_trainable_variables
+
+
+class Batcher(object):
+    """
+    runs fn on micro-batches of concurrently submitted requests
+    a batch goes out once it holds max_batch requests or its oldest request
+    has waited max_latency seconds, fn maps a list of requests to a list of results
+    when a batch fails its requests are retried one by one, so only the bad ones fail
+    """
+
+    def __init__(self, fn, max_batch=32, max_latency=0.01):
+        self.fn = fn
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.batch_sizes = []
+        self.t_first = None
+        self.t_last = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, request):
+        future = Future()
+        self.queue.put((time.time(), request, future))
+        return future
+
+    def _run(self):
+        while True:
+            items = [self.queue.get()]
+            deadline = items[0][0] + self.max_latency
+            # requests already waiting always join, the budget only bounds waiting for more
+            while len(items) < self.max_batch:
+                timeout = deadline - time.time()
+                try:
+                    if timeout > 0:
+                        items.append(self.queue.get(timeout=timeout))
+                    else:
+                        items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            results = self._apply([request for _, request, _ in items])
+            t = time.time()
+            with self.lock:
+                self.latencies.extend(t - t_submit for t_submit, _, _ in items)
+                self.batch_sizes.append(len(items))
+                self.t_first = items[0][0] if self.t_first is None else self.t_first
+                self.t_last = t
+            for (_, _, future), result in zip(items, results):
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    def _apply(self, requests):
+        try:
+            return self.fn(requests)
+        except Exception as e:
+            if len(requests) == 1:
+                return [e]
+        return [self._apply([request])[0] for request in requests]
+
+    def stats(self):
+        with self.lock:
+            if not self.latencies:
+                return {'requests': 0}
+            latencies = np.array(self.latencies)*1000
+            return {'requests': len(latencies),
+                    'batches': len(self.batch_sizes),
+                    'mean_batch': float(np.mean(self.batch_sizes)),
+                    'p50_ms': float(np.percentile(latencies, 50)),
+                    'p99_ms': float(np.percentile(latencies, 99)),
+                    'requests_per_sec': len(latencies)/max(self.t_last - self.t_first, 1e-9)}
+
+
+def parse_request(request):
+    """
+    validates {"story": str, "endings": [str, str]}
+    """
+    if not isinstance(request, dict):
+        raise ValueError('request must be a json object')
+    story, endings = request.get('story'), request.get('endings')
+    if not isinstance(story, str) or not isinstance(endings, list) or len(endings) != 2 \
+            or not all(isinstance(ending, str) for ending in endings):
+        raise ValueError('expected {"story": str, "endings": [str, str]}')
+    return story, endings[0], endings[1]
+
+
+class Classifier(object):
+    """
+    ROCStories ending classifier restored once from a fine-tuned checkpoint
+    or from a frozen graph written by export.py, which skips building the model
+    the architecture, n_ctx and max_len come from the checkpoint or graph metadata
+    shared_prefix runs each story once and both endings on its cached keys and values
+    """
+
+    def __init__(self, params, ckpt=None, graph=None, shared_prefix=False):
+        if graph is not None:
+            graph_def, metadata = load_frozen(graph)
+            update_architecture(params, metadata)
+        else:
+            metadata = update_from_checkpoint(params, ckpt)
+        self.text_encoder = TextEncoder(params["encoder_path"], params["bpe_path"],
+                                        tokenizer=params["tokenizer"])
+        self.model = Model(params)
+        self.model.setup_encoder(dict(self.text_encoder.encoder))
+        self.model.max_len = metadata['max_len']
+        self.shared_prefix = shared_prefix
+
+        if graph is not None:
+            self.model.sess.close()
+            self.model.sess = frozen_session()
+            self.X, self.logits = tf.import_graph_def(graph_def, name='', return_elements=['X:0', 'clf_logits:0'])
+        elif shared_prefix:
+            self.P = tf.placeholder(tf.int32, [None, None, 2])
+            self.PM = tf.placeholder(tf.float32, [None, None])
+            self.S = tf.placeholder(tf.int32, [None, 2, None, 2])
+            with quantized_scope(metadata):
+                self.logits = self.model.choice_logits(self.P, self.PM, self.S)
+        else:
+            # the classification path never reads the mask
+            self.X = tf.placeholder(tf.int32, [None, 2, None, 2])
+            with quantized_scope(metadata):
+                self.logits = self.model.model(self.X, tf.placeholder(tf.float32, [None, 2, None]),
+                                               lm_head=False)[0]
+        if graph is None:
+            self.model.sess.run(tf.global_variables_initializer())
+            self.model.restore(ckpt, find_trainable_variables('model'))
+
+    def __call__(self, requests):
+        n = len(requests)
+        tokens = self.text_encoder.encode([text for texts in zip(*requests) for text in texts], verbose=False)
+        x1, x2, x3 = tokens[:n], tokens[n:2*n], tokens[2*n:]
+        # endings are cut to the positions the model has, the story gives way to the longer one
+        n_ctx, max_len = self.model.params["n_ctx"], self.model.max_len
+        x2 = [a[:min(max_len, n_ctx - 3)] for a in x2]
+        x3 = [b[:min(max_len, n_ctx - 3)] for b in x3]
+        x1 = [s[:min(max_len, max(0, n_ctx - 3 - max(len(a), len(b))))] for s, a, b in zip(x1, x2, x3)]
+        if self.shared_prefix:
+            pmb, pm, smb = self.model.transform_choices(ragged(x1), [ragged(x2), ragged(x3)])
+            logits = self.model.sess.run(self.logits, {self.P: pmb, self.PM: pm, self.S: smb})
+        else:
+            xmb, mmb = self.model.transform_roc(ragged(x1), ragged(x2), ragged(x3))
+            n_ctx = int(mmb.sum(2).max())
+            logits = self.model.sess.run(self.logits, {self.X: xmb[:, :, :n_ctx]})
+        probs = np.exp(logits - logits.max(1, keepdims=True))
+        probs /= probs.sum(1, keepdims=True)
+        return [{'logits': l.tolist(), 'probs': p.tolist(), 'prediction': int(np.argmax(l))}
+                for l, p in zip(logits, probs)]
+
+
+def make_handler(batcher):
+    class Handler(BaseHTTPRequestHandler):
+
+        def reply(self, code, obj):
+            body = json.dumps(obj).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self.reply(200, batcher.stats())
+            else:
+                self.reply(404, {'error': 'not found'})
+
+        def do_POST(self):
+            try:
+                request = parse_request(json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0)))))
+            except ValueError as e:
+                self.reply(400, {'error': str(e)})
+                return
+            try:
+                self.reply(200, batcher.submit(request).result())
+            except Exception as e:
+                self.reply(500, {'error': str(e)})
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def serve_stdin(batcher):
+    """
+    one json request per input line, results are written in input order as they complete
+    """
+    futures = queue.Queue()
+
+    def write():
+        while True:
+            future = futures.get()
+            if future is None:
+                return
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {'error': str(e)}
+            sys.stdout.write(json.dumps(result)+'\n')
+            sys.stdout.flush()
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        try:
+            futures.put(batcher.submit(parse_request(json.loads(line))))
+        except ValueError as e:
+            future = Future()
+            future.set_exception(e)
+            futures.put(future)
+    futures.put(None)
+    writer.join()
+
+
+if __name__ == '__main__':
+    parser = get_parser()
+    parser.add_argument('--ckpt', type=str, default=None)
+    parser.add_argument('--graph', type=str, default=None)
+    parser.add_argument('--max_batch', type=int, default=32)
+    parser.add_argument('--max_latency_ms', type=float, default=10)
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--stdin', action='store_true')
+    parser.add_argument('--shared_prefix', action='store_true')
+    parser.set_defaults(desc='serve')
+
+    args = parser.parse_args()
+    if (args.ckpt is None) == (args.graph is None):
+        parser.error('give one of --ckpt and --graph')
+    if args.shared_prefix and args.graph:
+        parser.error('--shared_prefix needs --ckpt, the frozen graph only has the full sequence path')
+    classifier = Classifier(args.__dict__, ckpt=args.ckpt, graph=args.graph, shared_prefix=args.shared_prefix)
+    batcher = Batcher(classifier, max_batch=args.max_batch, max_latency=args.max_latency_ms/1000.)
+
+    if args.stdin:
+        serve_stdin(batcher)
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), make_handler(batcher))
+        print('serving on http://%s:%d' % (args.host, args.port), file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.server_close()
+    print(json.dumps(batcher.stats()), file=sys.stderr)
@@ -1,9 +1,17 @@
+import os
 import re
 import ftfy
+import heapq
 import json
 import spacy
+import hashlib
+import multiprocessing
 
 from tqdm import tqdm
+from itertools import islice
+from collections import OrderedDict
+
+from checkpoint import atomic_path
 
 def get_pairs(word):
     """
@@ -17,92 +25,335 @@ def get_pairs(word):
         prev_char = char
     return pairs
 
+_standardize_chars = [('—', '-'), ('–', '-'), ('―', '-'), ('…', '...'), ('´', "'")]
+# runs of a single punctuation char, backslashes are deliberately not padded:
+# the original '\\+' alternative compiled to a literal '+'
+_standardize_punct_re = re.compile(r'''([-~!";?+,)(/*\[\]}{|_])\1*''')
+_standardize_newline_re = re.compile(r'\s*\n\s*')
+_standardize_space_re = re.compile(r'[^\S\n]+')
+_ftfy_safe_re = re.compile(r'[\t\n\x20-\x25\x27-\x7e]*\Z')
+
+def _pad(m):
+    return ' '+m.group()+' '
+
 def text_standardize(text):
     """
     fixes some issues the spacy tokenizer had on books corpus
     also does some whitespace standardization
     """
-    text = text.replace('—', '-')
-    text = text.replace('–', '-')
-    text = text.replace('―', '-')
-    text = text.replace('…', '...')
-    text = text.replace('´', "'")
-    text = re.sub('''(-+|~+|!+|"+|;+|\?+|\++|,+|\)+|\(+|\\+|\/+|\*+|\[+|\]+|}+|{+|\|+|_+)''', r' \1 ', text)
-    text = re.sub('\s*\n\s*', ' \n ', text)
-    text = re.sub('[^\S\n]+', ' ', text)
+    if not text.isascii():
+        for a, b in _standardize_chars:
+            text = text.replace(a, b)
+    text = _standardize_punct_re.sub(_pad, text)
+    if '\n' in text:
+        text = _standardize_newline_re.sub(' \n ', text)
+    text = _standardize_space_re.sub(' ', text)
     return text.strip()
 
+def fix_text(text, ascii_fast_path=True):
+    """
+    ftfy.fix_text, skipped for printable ascii without html entities
+    where it has nothing to fix
+    """
+    if ascii_fast_path and _ftfy_safe_re.match(text):
+        return text
+    return ftfy.fix_text(text)
+
+def file_digest(*paths):
+    """
+    sha1 over the contents of a set of files, used to key on-disk caches
+    """
+    h = hashlib.sha1()
+    for path in paths:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+    return h.hexdigest()
+
+class BPECache(object):
+    """
+    lru cache of token -> bpe string with hit/miss counters
+    optionally snapshotted to a json file so a fresh process starts warm
+    """
+
+    def __init__(self, size=100000, path=None):
+        self.size = size
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+        self.journal = None
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, token):
+        return token in self.entries
+
+    def get(self, token):
+        word = self.entries.get(token)
+        if word is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(token)
+        return word
+
+    def __setitem__(self, token, word):
+        self.entries[token] = word
+        self.entries.move_to_end(token)
+        if self.journal is not None:
+            self.journal.append((token, word))
+        if self.size > 0 and len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+        if self.journal is not None:
+            self.journal = []
+
+    def track(self):
+        """
+        starts recording new entries for drain, used by pool workers
+        """
+        self.journal = []
+
+    def drain(self):
+        """
+        returns (entries, hits, misses) since the last drain and resets them
+        """
+        out = (self.journal, self.hits, self.misses)
+        self.journal, self.hits, self.misses = [], 0, 0
+        return out
+
+    def merge(self, entries, hits, misses):
+        for token, word in entries:
+            self[token] = word
+        self.hits += hits
+        self.misses += misses
+
+    def load(self):
+        """
+        a snapshot that cannot be read leaves the cache empty, the next save replaces it
+        """
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+            if self.size > 0:
+                entries = entries[-self.size:]
+            self.entries = OrderedDict(entries)
+        except (OSError, ValueError, TypeError, KeyError):
+            self.entries = OrderedDict()
+
+    def save(self):
+        if self.path is None:
+            return
+        with atomic_path(self.path) as tmp_path, open(tmp_path, 'w') as f:
+            json.dump(list(self.entries.items()), f)
+
+_pretok_exceptions = {
+    'mr.', 'mrs.', 'ms.', 'dr.', 'st.', 'jr.', 'sr.', 'mt.', 'prof.', 'vs.',
+    'etc.', 'inc.', 'co.', 'ltd.', 'a.m.', 'p.m.', 'e.g.', 'i.e.',
+}
+_pretok_prefix_re = re.compile(r'''^(?:\.\.+|[$£€#&'`<=>~%^@])''')
+_pretok_suffix_re = re.compile(r'''(?:(?<=[^\W\d_])(?i:n't)|(?i:'(?:s|m|re|ve|d|ll))|\.\.+|(?<=[a-z0-9%'])\.|[':%$#&`@^~<=>])$''')
+
+def regex_tokenize(text):
+    """
+    spacy-free approximation of the spacy 'en' tokenizer on text_standardize output
+    splits on spaces, then peels prefixes (quotes, currency, ellipses) and
+    suffixes (contractions, trailing periods, quotes, colons) off each chunk
+    """
+    tokens = []
+    for chunk in text.split(' '):
+        prefixes = []
+        suffixes = []
+        while chunk and chunk.lower() not in _pretok_exceptions:
+            m = _pretok_prefix_re.search(chunk)
+            if m and m.end() < len(chunk):
+                prefixes.append(m.group())
+                chunk = chunk[m.end():]
+                continue
+            m = _pretok_suffix_re.search(chunk)
+            if m and m.start() > 0:
+                suffixes.append(m.group())
+                chunk = chunk[:m.start()]
+                continue
+            break
+        tokens.extend(prefixes)
+        if chunk:
+            tokens.append(chunk)
+        tokens.extend(reversed(suffixes))
+    return tokens
+
+_worker_encoder = None
+
+def _init_encode_worker(*args, **kwargs):
+    global _worker_encoder
+    _worker_encoder = TextEncoder(*args, **kwargs)
+    _worker_encoder.cache.track()
+
+def _encode_chunk(texts):
+    # the bpe cache entries and counts of the chunk go back with it for the parent's cache
+    return _worker_encoder.encode(texts, verbose=False), _worker_encoder.cache.drain()
+
 class TextEncoder(object):
     """
     mostly a wrapper for a public python bpe tokenizer
     """
 
-    def __init__(self, encoder_path, bpe_path):
-        self.nlp = spacy.load('en', disable=['parser', 'tagger', 'ner', 'textcat'])
+    def __init__(self, encoder_path, bpe_path, cache_size=100000, cache_dir=None, tokenizer='spacy', ascii_fast_path=True):
+        self.encoder_path = encoder_path
+        self.bpe_path = bpe_path
+        self.cache_size = cache_size
+        self.cache_dir = cache_dir
+        self.tokenizer = tokenizer
+        self.ascii_fast_path = ascii_fast_path
+        self.pool = None
+        self.pool_jobs = None
+        if tokenizer == 'spacy':
+            self.nlp = spacy.load('en', disable=['parser', 'tagger', 'ner', 'textcat'])
+        elif tokenizer == 'regex':
+            self.nlp = None
+        else:
+            raise ValueError("unknown tokenizer {}".format(tokenizer))
         self.encoder = json.load(open(encoder_path))
         self.decoder = {v:k for k,v in self.encoder.items()}
         merges = open(bpe_path).read().split('\n')[1:-1]
         merges = [tuple(merge.split()) for merge in merges]
+        self.bpe_merges = merges
         self.bpe_ranks = dict(zip(merges, range(len(merges))))
-        self.cache = {}
+        cache_path = None
+        if cache_dir is not None:
+            cache_path = os.path.join(cache_dir, 'bpe_{}.json'.format(file_digest(encoder_path, bpe_path)))
+        self.cache = BPECache(cache_size, cache_path)
 
     def bpe(self, token):
-        word = tuple(token[:-1]) + ( token[-1] + '</w>',)
-        if token in self.cache:
-            return self.cache[token]
-        pairs = get_pairs(word)
-
-        if not pairs:
+        word = self.cache.get(token)
+        if word is not None:
+            return word
+        if len(token) < 2:
             return token+'</w>'
 
-        while True:
-            bigram = min(pairs, key = lambda pair: self.bpe_ranks.get(pair, float('inf')))
-            if bigram not in self.bpe_ranks:
-                break
-            first, second = bigram
-            new_word = []
-            i = 0
-            while i < len(word):
-                try:
-                    j = word.index(first, i)
-                    new_word.extend(word[i:j])
-                    i = j
-                except:
-                    new_word.extend(word[i:])
-                    break
-
-                if word[i] == first and i < len(word)-1 and word[i+1] == second:
-                    new_word.append(first+second)
-                    i += 2
-                else:
-                    new_word.append(word[i])
-                    i += 1
-            new_word = tuple(new_word)
-            word = new_word
-            if len(word) == 1:
-                break
-            else:
-                pairs = get_pairs(word)
-        word = ' '.join(word)
+        # symbols live in a doubly linked list indexed by their original
+        # position; merge candidates sit in a heap keyed by (rank, position)
+        word = list(token[:-1]) + [token[-1] + '</w>']
+        n = len(word)
+        prev = list(range(-1, n-1))
+        nxt = list(range(1, n+1))
+        heap = []
+        for i in range(n-1):
+            rank = self.bpe_ranks.get((word[i], word[i+1]))
+            if rank is not None:
+                heap.append((rank, i))
+        heapq.heapify(heap)
+
+        while heap:
+            rank = heap[0][0]
+            # every occurrence of the lowest ranked bigram is merged left to
+            # right before any pair created by those merges is considered
+            positions = []
+            while heap and heap[0][0] == rank:
+                positions.append(heapq.heappop(heap)[1])
+            first, second = self.bpe_merges[rank]
+            merged = []
+            for i in positions:
+                j = nxt[i]
+                if word[i] != first or j >= n or word[j] != second:
+                    continue
+                word[i] = first+second
+                word[j] = None
+                nxt[i] = nxt[j]
+                if nxt[j] < n:
+                    prev[nxt[j]] = i
+                merged.append(i)
+            for i in merged:
+                if word[i] is None:
+                    continue
+                if prev[i] >= 0:
+                    r = self.bpe_ranks.get((word[prev[i]], word[i]))
+                    if r is not None:
+                        heapq.heappush(heap, (r, prev[i]))
+                if nxt[i] < n:
+                    r = self.bpe_ranks.get((word[i], word[nxt[i]]))
+                    if r is not None:
+                        heapq.heappush(heap, (r, i))
+
+        word = ' '.join(w for w in word if w is not None)
         if word == '\n  </w>':
             word = '\n</w>'
         self.cache[token] = word
         return word
 
-    def encode(self, texts, verbose=True):
-        texts_tokens = []
-        if verbose:
-            for text in tqdm(texts, ncols=80, leave=False):
-                text = self.nlp(text_standardize(ftfy.fix_text(text)))
-                text_tokens = []
-                for token in text:
-                    text_tokens.extend([self.encoder.get(t, 0) for t in self.bpe(token.text.lower()).split(' ')])
-                texts_tokens.append(text_tokens)
-        else:
+    def get_pool(self, n_jobs):
+        """
+        process pool whose workers each load their own TextEncoder once
+        """
+        if n_jobs < 0:
+            n_jobs = multiprocessing.cpu_count()
+        if n_jobs < 1:
+            raise ValueError('n_jobs must be positive or -1 for all cpus, got {}'.format(n_jobs))
+        if self.pool is None or self.pool_jobs != n_jobs:
+            self.close()
+            self.pool = multiprocessing.Pool(n_jobs,
+                                             initializer=_init_encode_worker,
+                                             initargs=(self.encoder_path, self.bpe_path,
+                                                       self.cache_size, self.cache_dir, self.tokenizer,
+                                                       self.ascii_fast_path))
+            self.pool_jobs = n_jobs
+        return self.pool
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+            self.pool_jobs = None
+
+    def pretokenize(self, texts, batch_size=1000):
+        """
+        lazily splits standardized texts into word strings
+        """
+        if self.nlp is None:
             for text in texts:
-                text = self.nlp(text_standardize(ftfy.fix_text(text)))
-                text_tokens = []
-                for token in text:
-                    text_tokens.extend([self.encoder.get(t, 0) for t in self.bpe(token.text.lower()).split(' ')])
-                texts_tokens.append(text_tokens)
-        return texts_tokens
+                yield regex_tokenize(text)
+        else:
+            for doc in self.nlp.pipe(texts, batch_size=batch_size):
+                yield [token.text for token in doc]
+
+    def iter_encode(self, texts, n_jobs=1, chunksize=256, batch_size=1000):
+        """
+        lazily yields the token ids of each text
+        ftfy -> text_standardize -> pretokenize -> bpe -> ids
+        """
+        if n_jobs != 1:
+            # imap keeps chunk order so the result matches the serial path
+            pool = self.get_pool(n_jobs)
+            texts = iter(texts)
+            chunks = iter(lambda: list(islice(texts, chunksize)), [])
+            for chunk_tokens, cache in pool.imap(_encode_chunk, chunks):
+                self.cache.merge(*cache)
+                yield from chunk_tokens
+            return
+        texts = (text_standardize(fix_text(text, self.ascii_fast_path)) for text in texts)
+        for words in self.pretokenize(texts, batch_size=batch_size):
+            text_tokens = []
+            for word in words:
+                text_tokens.extend([self.encoder.get(t, 0) for t in self.bpe(word.lower()).split(' ')])
+            yield text_tokens
+
+    def encode(self, texts, verbose=True, n_jobs=1, chunksize=256, batch_size=1000):
+        texts_tokens = self.iter_encode(texts, n_jobs=n_jobs, chunksize=chunksize, batch_size=batch_size)
+        if verbose:
+            texts_tokens = tqdm(texts_tokens, total=len(texts), ncols=80, leave=False)
+        return list(texts_tokens)
+
+    def decode(self, tokens):
+        """
+        bpe ids back to lowercased, space separated words
+        """
+        return ''.join(self.decoder.get(t, '') for t in tokens).replace('</w>', ' ').strip()
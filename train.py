@@ -1,22 +1,26 @@
 import os
 import math
 import json
-import joblib
+import time
 import random
 import argparse
+import resource
 import numpy as np
 import tensorflow as tf
 
 from functools import partial
-from sklearn.utils import shuffle
+from itertools import islice
 from sklearn.metrics import accuracy_score
 
-from opt import adam, warmup_cosine, warmup_linear, warmup_constant
-from datasets import rocstories
+from opt import opts, warmup_cosine, warmup_linear, warmup_constant
+from datasets import rocstories, rocstories_paths
 from analysis import rocstories as rocstories_analysis
-from text_utils import TextEncoder
-from utils import encode_dataset, iter_data, find_trainable_variables, get_ema_vars
-from utils import convert_gradient_to_tensor, shape_list, ResultLogger, assign_to_gpu, average_grads, make_path
+from text_utils import TextEncoder, file_digest
+from utils import encode_dataset, iter_buckets, prefetch, find_trainable_variables, get_ema_vars
+from utils import ragged, ragged_index, ragged_columns, save_encoded, load_encoded, iter_params
+from utils import convert_gradient_to_tensor, shape_list, ResultLogger, assign_to_gpu, average_grads, accumulate_grads
+from utils import scale_grads, add_grads, gather_rows
+from checkpoint import AsyncSaver, load_checkpoint, read_header
 
 
 def gelu(x):
@@ -32,6 +36,12 @@ act_fns = {
     'gelu': gelu
 }
 
+compute_dtypes = {
+    'fp32': tf.float32,
+    'bf16': tf.bfloat16,
+    'fp16': tf.float16,
+}
+
 lr_schedules = {
     'warmup_cosine': warmup_cosine,
     'warmup_linear': warmup_linear,
@@ -40,12 +50,15 @@ lr_schedules = {
 
 
 def _norm(x, g=None, b=None, e=1e-5, axis=[1]):
+    # statistics are always float32, the result goes back to the compute dtype
+    dtype = x.dtype
+    x = tf.cast(x, tf.float32)
     u = tf.reduce_mean(x, axis=axis, keep_dims=True)
     s = tf.reduce_mean(tf.square(x-u), axis=axis, keep_dims=True)
     x = (x - u) * tf.rsqrt(s + e)
     if g is not None and b is not None:
         x = x*g + b
-    return x
+    return tf.cast(x, dtype)
 
 
 def norm(x, scope, axis=[-1]):
@@ -57,18 +70,11 @@ def norm(x, scope, axis=[-1]):
         return _norm(x, g, b, axis=axis)
 
 
-def dropout(x, pdrop, train):
-    if train and pdrop > 0:
-        x = tf.nn.dropout(x, 1-pdrop)
-    return x
-
-
-def mask_attn_weights(w):
-    n = shape_list(w)[-1]
-    b = tf.matrix_band_part(tf.ones([n, n]), -1, 0)
-    b = tf.reshape(b, [1, 1, n, n])
-    w = w*b + -1e9*(1-b)
-    return w
+def attn_bias(n):
+    """
+    additive causal mask, 0 on and below the diagonal and -1e9 above it
+    """
+    return np.triu(np.full([n, n], -1e9, dtype=np.float32), 1)
 
 
 def split_states(x, n):
@@ -105,6 +111,7 @@ def conv1d(x, scope, nf, rf,
         nx = shape_list(x)[-1]
         w = tf.get_variable("w", [rf, nx, nf], initializer=w_init)
         b = tf.get_variable("b", [nf], initializer=b_init)
+        w, b = tf.cast(w, x.dtype), tf.cast(b, x.dtype)
         if rf == 1: #faster 1x1 conv
             c = tf.reshape(tf.matmul(tf.reshape(x, [-1, nx]), tf.reshape(w, [-1, nf]))+b, shape_list(x)[:-1]+[nf])
         else: #was used to train LM
@@ -117,6 +124,7 @@ def clf(x, ny, w_init=tf.random_normal_initializer(stddev=0.02), b_init=tf.const
         nx = shape_list(x)[-1]
         w = tf.get_variable("w", [nx, ny], initializer=w_init)
         b = tf.get_variable("b", [ny], initializer=b_init)
+        w, b = tf.cast(w, x.dtype), tf.cast(b, x.dtype)
         return tf.matmul(x, w)+b
 
 
@@ -141,7 +149,8 @@ class Model(object):
         self.params = params
         self.logger = ResultLogger(path=os.path.join(self.params["log_dir"],
                                                      '{}.jsonl'.format(self.params["desc"])),
-                                   **args.__dict__)
+                                   append=self.params["resume"],
+                                   **self.params)
         self.encoder = None
         self.max_len = None
         self.n_vocab = None
@@ -151,13 +160,24 @@ class Model(object):
         self.n_special = 3
         self.n_updates = 0
         self.n_epochs = 0
+        self.epoch_step = 0
+        self.epoch_rng_state = None
+        self.accumulate = None
+        self.bias = None
+        self.step, self.dropout_seed, self.dropout_site = None, None, 0
+        self.checkpoints, self.embedded, self.checkpoint_out = None, None, None
+        self.n_examples, self.train_time = 0, 0.
         self.n_batch_train = 0
         self.sess = tf.Session(config=tf.ConfigProto(allow_soft_placement=True))
+        self.saver = AsyncSaver()
 
         self.X_train, self.M_train, self.Y_train = None, None, None
         self.X, self.M, self.Y = None, None, None
         self.n_train, self.n_valid = None, None
         self.trX, self.trM, self.vaX, self.vaM, self.teX, self.teM = None, None, None, None, None, None
+        self.trL, self.vaL, self.teL = None, None, None
+        self.n_real_tokens, self.n_padded_tokens = 0, 0
+        self.input_wait, self.n_steps = 0., 0
 
         self.vaY = None
         self.trY = None
@@ -173,44 +193,197 @@ class Model(object):
 
     def save(self, path, params):
         ps = self.sess.run(params)
-        joblib.dump(ps, make_path(path))
+        metadata = dict(self.params, n_vocab=self.n_vocab, n_special=self.n_special, max_len=self.max_len)
+        self.saver.save(path,
+                        [(p.name, ip) for p, ip in zip(params, ps)],
+                        dtype=np.float16 if self.params["ckpt_fp16"] else None,
+                        metadata=metadata)
+
+    def restore(self, path, params):
+        self.saver.join()
+        tensors, _ = load_checkpoint(path)
+        for p in params:
+            p.load(np.asarray(tensors[p.name], dtype=p.dtype.base_dtype.as_numpy_dtype), self.sess)
+
+    def save_state(self, path):
+        """
+        full training state: every global variable (weights and optimizer slots),
+        progress counters and the numpy rng state the current epoch's order was drawn from
+        """
+        variables = tf.global_variables()
+        values = self.sess.run(variables)
+        name, keys, pos, has_gauss, cached_gaussian = self.epoch_rng_state
+        metadata = {'n_updates': self.n_updates,
+                    'n_epochs': self.n_epochs,
+                    'epoch_step': self.epoch_step,
+                    'best_score': self.best_score,
+                    'epoch_rng_state': [name, keys.tolist(), pos, has_gauss, cached_gaussian]}
+        self.saver.save(path, [(v.name, value) for v, value in zip(variables, values)], metadata=metadata)
+
+    def restore_state(self, path):
+        self.saver.join()
+        tensors, metadata = load_checkpoint(path)
+        variables = tf.global_variables()
+        missing = [v.name for v in variables if v.name not in tensors]
+        if missing:
+            raise ValueError('%s has no state for %s, was it saved with different --opt, --sparse_embd or '
+                             '--grad_accum_steps?' % (path, ', '.join(missing)))
+        for v in variables:
+            v.load(np.asarray(tensors[v.name]), self.sess)
+        self.n_updates = metadata['n_updates']
+        self.n_epochs = metadata['n_epochs']
+        self.epoch_step = metadata['epoch_step']
+        self.best_score = metadata['best_score']
+        name, keys, pos, has_gauss, cached_gaussian = metadata['epoch_rng_state']
+        self.epoch_rng_state = (name, np.asarray(keys, dtype=np.uint32), pos, has_gauss, cached_gaussian)
+        print('resumed at epoch %d step %d (%d updates)' % (self.n_epochs, self.epoch_step, self.n_updates))
+
+    def load_pretrained(self, params):
+        """
+        stream the pretrained weights from the memory-mapped shards into the first n_transfer params
+        each variable is fed through its initializer so no constants end up in the graph
+        """
+        shapes = json.load(open('model/params_shapes.json'))
+        init_params = iter_params(shapes, ['model/params_{}.npy'.format(n) for n in range(10)])
+
+        if self.params["n_transfer"] == -1:
+            self.params["n_transfer"] = 0
+        else:
+            self.params["n_transfer"] = 1 + self.params["n_transfer"] * 12
+
+        load_logger = ResultLogger(path=os.path.join(self.params["log_dir"],
+                                                     '{}_load.jsonl'.format(self.params["desc"])))
+        t_start = time.time()
+        special = (np.random.randn(self.n_special, self.params["n_embd"])*0.02).astype(np.float32)
+        for i, p in enumerate(params[:self.params["n_transfer"]]):
+            t = time.time()
+            if i == 0:
+                positions = next(init_params)[:self.params["n_ctx"]]
+                ip = np.concatenate([next(init_params), special, positions], 0)
+            else:
+                ip = next(init_params)
+            p.load(ip, self.sess)
+            load_logger.log(name=p.name, shape=list(ip.shape), seconds=time.time()-t)
+        load_logger.close()
+        print('loaded %d pretrained params in %.2fs' % (self.params["n_transfer"], time.time()-t_start))
 
     def log(self, params):
-        tr_logits, tr_cost = self.iter_apply(self.trX[:self.n_valid], self.trM[:self.n_valid], self.trY[:self.n_valid])
-        va_logits, va_cost = self.iter_apply(self.vaX, self.vaM, self.vaY)
+        tr_logits, tr_cost = self.iter_apply(self.trX[:self.n_valid], self.trM[:self.n_valid], self.trY[:self.n_valid],
+                                             self.trL[:self.n_valid])
+        va_logits, va_cost = self.iter_apply(self.vaX, self.vaM, self.vaY, self.vaL)
         tr_cost = tr_cost / len(self.trY[:self.n_valid])
         va_cost = va_cost / self.n_valid
         tr_acc = accuracy_score(self.trY[:self.n_valid], np.argmax(tr_logits, 1)) * 100.
         va_acc = accuracy_score(self.vaY, np.argmax(va_logits, 1)) * 100.
 
+        pad_eff = self.n_real_tokens / max(self.n_padded_tokens, 1)
+        input_wait = self.input_wait / max(self.n_steps, 1)
+        ex_per_sec = self.n_examples / max(self.train_time, 1e-9)
+        self.n_real_tokens, self.n_padded_tokens = 0, 0
+        self.input_wait, self.n_steps = 0., 0
+        self.n_examples, self.train_time = 0, 0.
+
         self.logger.log(n_epochs=self.n_epochs,
                         n_updates=self.n_updates,
                         tr_cost=tr_cost,
                         va_cost=va_cost,
                         tr_acc=tr_acc,
-                        va_acc=va_acc)
+                        va_acc=va_acc,
+                        pad_eff=pad_eff,
+                        input_wait=input_wait,
+                        ex_per_sec=ex_per_sec,
+                        maxrss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.)
 
         print('%d %d %.3f %.3f %.2f %.2f' % (self.n_epochs, self.n_updates, tr_cost, va_cost, tr_acc, va_acc))
 
         score = va_acc
         if score > self.best_score:
             self.best_score = score
-            self.save(os.path.join(self.params["save_dir"], self.params["desc"], 'best_params.jl'), params)
-
-    def _attn(self, q, k, v, train=False, scale=False):
+            self.save(os.path.join(self.params["save_dir"], self.params["desc"], 'best_params.ckpt'), params)
+
+    def dropout(self, x, pdrop, train, noise_shape=None):
+        """
+        dropout drawn from a stateless rng seeded by dropout_seed and the next site number
+        the masks only depend on the run seed, step, tower and site, so recomputed blocks
+        rebuild the masks of the forward pass and a resumed run draws the ones it would have
+        """
+        if not (train and pdrop > 0):
+            return x
+        self.dropout_site += 1
+        shape = tf.shape(x) if noise_shape is None else noise_shape
+        u = tf.random.stateless_uniform(shape, self.dropout_seed + [0, self.dropout_site],
+                                        dtype=x.dtype.base_dtype)
+        return x * tf.floor(1 - pdrop + u) / (1 - pdrop)
+
+    def causal_bias(self):
+        """
+        attn_bias for n_ctx positions rounded up to a whole number of attention blocks
+        built once per graph and sliced by every layer
+        """
+        block = max(self.params["attn_block"], 1)
+        n = -(-self.params["n_ctx"] // block) * block
+        if self.bias is None or self.bias.graph is not tf.get_default_graph() or shape_list(self.bias)[0] != n:
+            self.bias = tf.constant(attn_bias(n), name='attn_bias')
+        return self.bias
+
+    def _attn(self, q, k, v, train=False, scale=False, mask=None):
+        # with cached keys the queries are the last n_q of n_k positions
+        n_q, n_k = shape_list(q)[2], shape_list(v)[2]
         w = tf.matmul(q, k)
+        # masking and softmax run in float32, -1e9 is out of float16 range
+        w = tf.cast(w, tf.float32)
 
         if scale:
             n_state = shape_list(v)[-1]
             w = w * tf.rsqrt(tf.cast(n_state, tf.float32))
 
-        w = mask_attn_weights(w)
+        if mask is None:
+            w = w + self.causal_bias()[n_k-n_q:n_k, :n_k]
+        else:
+            # the cached keys all come before the queries, only their padding is masked
+            n_past = n_k - n_q
+            w = tf.concat([w[:, :, :, :n_past] + (1 - mask[:, None, None, :]) * -1e9,
+                           w[:, :, :, n_past:] + self.causal_bias()[:n_q, :n_q]], 3)
         w = tf.nn.softmax(w)
-        w = dropout(w, self.params["attn_pdrop"], train)
+        w = tf.cast(w, v.dtype)
+        w = self.dropout(w, self.params["attn_pdrop"], train)
         a = tf.matmul(w, v)
         return a
 
-    def attn(self, x, scope, n_state, n_head, train=False, scale=False):
+    def _blocked_attn(self, q, k, v, scale=False):
+        """
+        inference attention one block of queries at a time
+        a block only scores the keys up to its last query, so the
+        [batch, head, n, n] weights are never materialized
+        """
+        block = self.params["attn_block"]
+        bias = self.causal_bias()
+        n_batch, n_head, n, n_state = shape_list(q)
+        n_block = (n + block - 1) // block
+        q = tf.pad(q, [[0, 0], [0, 0], [0, n_block*block - n], [0, 0]])
+        q = tf.transpose(tf.reshape(q, [n_batch, n_head, n_block, block, n_state]), [2, 0, 1, 3, 4])
+
+        def attend_block(args):
+            i, qb = args
+            end = tf.minimum((i+1)*block, n)
+            w = tf.cast(tf.matmul(qb, k[:, :, :, :end]), tf.float32)
+            if scale:
+                w = w * tf.rsqrt(tf.cast(n_state, tf.float32))
+            w = w + bias[i*block:(i+1)*block, :end]
+            w = tf.cast(tf.nn.softmax(w), v.dtype)
+            return tf.matmul(w, v[:, :, :end])
+
+        a = tf.map_fn(attend_block, (tf.range(n_block), q), dtype=v.dtype, parallel_iterations=1)
+        a = tf.reshape(tf.transpose(a, [1, 2, 0, 3, 4]), [n_batch, n_head, n_block*block, n_state])
+        return a[:, :, :n]
+
+    def attn(self, x, scope, n_state, n_head, train=False, scale=False, past=None, mask=None):
+        """
+        returns the attention output and the keys and values of x, past is the
+        [keys, values] of the positions before x as returned by earlier calls
+        keys are kept transposed, [batch, head, state, time]
+        mask [batch, time] marks which of the past positions x can attend to
+        """
         assert n_state % n_head == 0
         with tf.variable_scope(scope):
             c = conv1d(x, 'c_attn', n_state * 3, 1, train=train)
@@ -218,11 +391,18 @@ class Model(object):
             q = split_heads(q, n_head)
             k = split_heads(k, n_head, k=True)
             v = split_heads(v, n_head)
-            a = self._attn(q, k, v, train=train, scale=scale)
+            present = [k, v]
+            if past is not None:
+                k = tf.concat([past[0], k], 3)
+                v = tf.concat([past[1], v], 2)
+            if past is None and not train and self.params["attn_block"] > 0:
+                a = self._blocked_attn(q, k, v, scale=scale)
+            else:
+                a = self._attn(q, k, v, train=train, scale=scale, mask=mask)
             a = merge_heads(a)
             a = conv1d(a, 'c_proj', n_state, 1, train=train)
-            a = dropout(a, self.params["resid_pdrop"], train)
-            return a
+            a = self.dropout(a, self.params["resid_pdrop"], train)
+            return a, present
 
     def mlp(self, x, scope, n_state, train=False):
         with tf.variable_scope(scope):
@@ -230,62 +410,276 @@ class Model(object):
             act = act_fns[self.params["afn"]]
             h = act(conv1d(x, 'c_fc', n_state, 1, train=train))
             h2 = conv1d(h, 'c_proj', nx, 1, train=train)
-            h2 = dropout(h2, self.params["resid_pdrop"], train)
+            h2 = self.dropout(h2, self.params["resid_pdrop"], train)
             return h2
 
-    def block(self, x, scope, train=False, scale=False):
+    def block(self, x, scope, train=False, scale=False, past=None, mask=None):
         with tf.variable_scope(scope):
             nx = shape_list(x)[-1]
-            a = self.attn(x, 'attn', nx, self.params["n_head"], train=train, scale=scale)
+            a, present = self.attn(x, 'attn', nx, self.params["n_head"], train=train, scale=scale, past=past,
+                                   mask=mask)
             n = norm(x + a, 'ln_1')
             m = self.mlp(n, 'mlp', nx * 4, train=train)
             h = norm(n + m, 'ln_2')
-            return h
+            return h, present
 
-    def embed(self, X, we):
-        we = convert_gradient_to_tensor(we)
-        e = tf.gather(we, X)
-        h = tf.reduce_sum(e, 2)
+    def blocks(self, h, layers, train=False):
+        for layer in layers:
+            # each block draws 3 dropout masks, numbered from its layer
+            self.dropout_site = 4*layer
+            h, _ = self.block(h, 'h%d' % layer, train=train, scale=True)
         return h
 
-    def model(self, X, M, Y, train=False, reuse=False):
-        with tf.variable_scope('model', reuse=reuse):
-            we = tf.get_variable("we",
-                                 [self.n_vocab + self.n_special + self.params["n_ctx"], self.params["n_embd"]],
-                                 initializer=tf.random_normal_initializer(stddev=0.02))
-
-            we = dropout(we, self.params["embd_pdrop"], train)
-
-            X = tf.reshape(X, [-1, self.params["n_ctx"], 2])
-            M = tf.reshape(M, [-1, self.params["n_ctx"]])
+    def embedding(self):
+        """
+        the token, special token and position embedding, also the tied lm head
+        created or reused in the enclosing 'model' variable scope
+        """
+        return tf.get_variable("we",
+                               [self.n_vocab + self.n_special + self.params["n_ctx"], self.params["n_embd"]],
+                               initializer=tf.random_normal_initializer(stddev=0.02))
+
+    def embed(self, X, we, train=False):
+        # the Defun only shapes the gradient, inference graphs do without it
+        if train:
+            we = convert_gradient_to_tensor(we)
+        e = gather_rows(we, X)
+        h = tf.reduce_sum(e, 2)
+        return h
 
-            h = self.embed(X, we)
-            for layer in range(self.params["n_layer"]):
-                h = self.block(h, 'h%d' % layer, train=train, scale=True)
+    def sparse_embed(self, X, we, train=False):
+        """
+        gathers straight from the embedding variable so its gradient stays IndexedSlices
+        dropout is applied to the gathered rows rather than to the whole matrix
+        """
+        e = self.dropout(tf.gather(we, X), self.params["embd_pdrop"], train)
+        h = tf.reduce_sum(e, 2)
+        return h
 
-            lm_h = tf.reshape(h[:, :-1], [-1, self.params["n_embd"]])
-            lm_logits = tf.matmul(lm_h, we, transpose_b=True)
-            lm_losses = tf.nn.sparse_softmax_cross_entropy_with_logits(logits=lm_logits,
-                                                                       labels=tf.reshape(X[:, 1:, 0], [-1]))
-            lm_losses = tf.reshape(lm_losses, [shape_list(X)[0], shape_list(X)[1] - 1])
-            lm_losses = tf.reduce_sum(lm_losses * M[:, 1:], 1) / tf.reduce_sum(M[:, 1:], 1)
+    def pool(self, h, X):
+        """
+        the hidden state at the classify token of each of the sequences X [n, n_ctx, 2]
+        h [n, n_ctx, n_embd] are their block outputs
+        """
+        n, n_ctx = shape_list(X)[:2]
+        h = tf.reshape(h, [-1, self.params["n_embd"]])
+        pool_idx = tf.cast(tf.argmax(tf.cast(tf.equal(X[:, :, 0], self.clf_token), tf.float32), 1), tf.int32)
+        return tf.gather(h, tf.range(n, dtype=tf.int32) * n_ctx + pool_idx)
+
+    def model(self, X, M, Y=None, train=False, reuse=False, lm_head=True, tower=0):
+        """
+        returns clf_logits, clf_losses and lm_losses
+        the losses are None when Y is None or without lm_head
+        while training the dropout masks follow the step fed to self.step
+        """
+        with tf.variable_scope('model', reuse=reuse):
+            we = self.embedding()
+
+            n_layer = self.params["n_layer"]
+            if train:
+                if self.step is None or self.step.graph is not tf.get_default_graph():
+                    self.step = tf.placeholder_with_default(tf.constant(0, tf.int64), [], name='step')
+                # blocks use sites 4*layer+1..3, the embedding and classifier come after them
+                self.dropout_seed = tf.stack([self.step, tf.constant(
+                    (self.params["seed"]*self.params["n_gpu"] + tower) * 2**16, dtype=tf.int64)])
+                self.dropout_site = 4*n_layer
+
+            # the sparse path drops out the gathered rows and has no trained lm head,
+            # so only the dense one draws a mask over the whole matrix
+            we_var = we
+            if not self.params["sparse_embd"]:
+                we = self.dropout(we, self.params["embd_pdrop"], train)
+
+            n_ctx = shape_list(X)[2]
+            X = tf.reshape(X, [-1, n_ctx, 2])
+            M = tf.reshape(M, [-1, n_ctx])
+
+            # master weights stay float32, each layer casts them to the compute dtype
+            dtype = compute_dtypes[self.params["precision"]]
+            if self.params["sparse_embd"]:
+                h = self.sparse_embed(X, we_var, train=train)
+            else:
+                h = self.embed(X, we, train=train)
+            h = tf.cast(h, dtype)
+            k = self.params["recompute"]
+            if train and k > 0:
+                # only the input of every k-th block is kept for the backward pass,
+                # recompute_gradients rebuilds the blocks in between from it
+                self.embedded = h
+                self.checkpoints = []
+                for start in range(0, self.params["n_layer"], k):
+                    h = tf.stop_gradient(h)
+                    layers = range(start, min(start+k, self.params["n_layer"]))
+                    self.checkpoints.append((h, layers))
+                    h = self.blocks(h, layers, train=train)
+                h = self.checkpoint_out = tf.stop_gradient(h)
+            else:
+                h = self.blocks(h, range(self.params["n_layer"]), train=train)
 
-            clf_h = tf.reshape(h, [-1, self.params["n_embd"]])
-            pool_idx = tf.cast(tf.argmax(tf.cast(tf.equal(X[:, :, 0], self.clf_token), tf.float32), 1), tf.int32)
-            clf_h = tf.gather(clf_h, tf.range(shape_list(X)[0], dtype=tf.int32) * self.params["n_ctx"] + pool_idx)
+            lm_losses = None
+            if lm_head:
+                lm_losses = self.lm_losses(h, we, X, M, train=train)
 
+            clf_h = self.pool(h, X)
             clf_h = tf.reshape(clf_h, [-1, 2, self.params["n_embd"]])
             if train and self.params["clf_pdrop"] > 0:
                 shape = shape_list(clf_h)
                 shape[1] = 1
-                clf_h = tf.nn.dropout(clf_h, 1 - self.params["clf_pdrop"], shape)
+                self.dropout_site = 4*n_layer + 2
+                clf_h = self.dropout(clf_h, self.params["clf_pdrop"], train, noise_shape=shape)
             clf_h = tf.reshape(clf_h, [-1, self.params["n_embd"]])
-            clf_logits = clf(clf_h, 1, train=train)
+            clf_logits = tf.cast(clf(clf_h, 1, train=train), tf.float32)
             clf_logits = tf.reshape(clf_logits, [-1, 2])
 
-            clf_losses = tf.nn.sparse_softmax_cross_entropy_with_logits(logits=clf_logits, labels=Y)
+            clf_losses = None
+            if Y is not None:
+                clf_losses = tf.nn.sparse_softmax_cross_entropy_with_logits(logits=clf_logits, labels=Y)
             return clf_logits, clf_losses, lm_losses
 
+    def lm_losses(self, h, we, X, M, train=False):
+        """
+        per example loss of predicting X[:, 1:] from h[:, :-1], averaged under M
+        full scores every position against every row of the tied we, positional rows included
+        masked scores only the positions M keeps and only the token rows
+        sampled is masked with a sampled softmax over the token rows while training
+        """
+        if self.params["lm_loss"] == 'full':
+            lm_h = tf.reshape(h[:, :-1], [-1, self.params["n_embd"]])
+            lm_logits = tf.matmul(lm_h, tf.cast(we, h.dtype), transpose_b=True)
+            lm_logits = tf.cast(lm_logits, tf.float32)
+            lm_losses = tf.nn.sparse_softmax_cross_entropy_with_logits(logits=lm_logits,
+                                                                       labels=tf.reshape(X[:, 1:, 0], [-1]))
+            lm_losses = tf.reshape(lm_losses, [shape_list(X)[0], shape_list(X)[1] - 1])
+            return tf.reduce_sum(lm_losses * M[:, 1:], 1) / tf.reduce_sum(M[:, 1:], 1)
+
+        n_rows = self.n_vocab + self.n_special
+        idx = tf.where(M[:, 1:] > 0)
+        lm_h = tf.gather_nd(h[:, :-1], idx)
+        labels = tf.gather_nd(X[:, 1:, 0], idx)
+        if self.params["lm_loss"] == 'sampled' and train:
+            # the labels and samples are all below n_rows, so only those rows of we are gathered
+            lm_losses = tf.nn.sampled_softmax_loss(we, tf.zeros([n_rows]), tf.cast(labels[:, None], tf.int64),
+                                                   tf.cast(lm_h, tf.float32), self.params["lm_samples"], n_rows)
+        else:
+            # slicing the token rows out of we would copy its gradient,
+            # the positional rows stay in the matmul and are masked out of the softmax instead
+            lm_logits = tf.matmul(lm_h, tf.cast(we, h.dtype), transpose_b=True)
+            lm_logits = tf.cast(lm_logits, tf.float32) + np.where(np.arange(shape_list(we)[0]) < n_rows, 0,
+                                                                  -1e9).astype(np.float32)
+            lm_losses = tf.nn.sparse_softmax_cross_entropy_with_logits(logits=lm_logits, labels=labels)
+        lm_losses = tf.unsorted_segment_sum(lm_losses * tf.gather_nd(M[:, 1:], idx), idx[:, 0], shape_list(X)[0])
+        return lm_losses / tf.reduce_sum(M[:, 1:], 1)
+
+    def lm(self, X, past=None):
+        """
+        inference language model over X [batch, n, 2] of (token, position) ids
+        past holds the cached keys and values of the positions before X for every
+        layer, stacked as [layer, batch, head, state, time] and [layer, batch, head, time, state]
+        returns the next token logits over the real vocabulary at the last position
+        and the keys and values of X in the same layout
+        """
+        with tf.variable_scope('model', reuse=tf.AUTO_REUSE):
+            we = self.embedding()
+            dtype = compute_dtypes[self.params["precision"]]
+            h = tf.cast(tf.reduce_sum(gather_rows(we, X), 2), dtype)
+            presents = []
+            for layer in range(self.params["n_layer"]):
+                layer_past = None if past is None else [past[0][layer], past[1][layer]]
+                h, present = self.block(h, 'h%d' % layer, scale=True, past=layer_past)
+                presents.append(present)
+            logits = tf.matmul(h[:, -1], tf.cast(we[:self.n_vocab], dtype), transpose_b=True)
+            return tf.cast(logits, tf.float32), [tf.stack([p[0] for p in presents]), tf.stack([p[1] for p in presents])]
+
+    def choice_logits(self, P, PM, S):
+        """
+        inference multiple-choice classification that runs the shared prefix once
+        P [batch, n_p, 2] is the prefix of every candidate and PM [batch, n_p] its mask,
+        S [batch, n_choice, n_s, 2] holds the candidates, positioned right after their prefix
+        each candidate attends to the cached prefix keys and values, returns [batch, n_choice]
+        """
+        with tf.variable_scope('model', reuse=tf.AUTO_REUSE):
+            we = self.embedding()
+            dtype = compute_dtypes[self.params["precision"]]
+            n_batch, n_choice, n_s = shape_list(S)[:3]
+
+            h = tf.cast(self.embed(P, we), dtype)
+            presents = []
+            for layer in range(self.params["n_layer"]):
+                h, present = self.block(h, 'h%d' % layer, scale=True)
+                presents.append(present)
+
+            # every candidate reads the cache of its example
+            idx = tf.reshape(tf.tile(tf.range(n_batch)[:, None], [1, n_choice]), [-1])
+            mask = tf.gather(PM, idx)
+            S = tf.reshape(S, [-1, n_s, 2])
+            h = tf.cast(self.embed(S, we), dtype)
+            for layer, (k, v) in enumerate(presents):
+                h, _ = self.block(h, 'h%d' % layer, scale=True, past=[tf.gather(k, idx), tf.gather(v, idx)],
+                                  mask=mask)
+
+            clf_logits = tf.cast(clf(self.pool(h, S), 1), tf.float32)
+            return tf.reshape(clf_logits, [-1, n_choice])
+
+    def generate(self, X, n_tokens, top_k=1, temperature=1., cache=True):
+        """
+        extends the contexts X [batch, n, 2] by n_tokens >= 1 sampled tokens, returns [batch, n_tokens]
+        top_k=1 is greedy decoding, top_k=0 samples from the whole distribution
+        each step feeds only the new token and extends the per layer key/value cache,
+        cache=False reruns the whole sequence instead and is kept as the reference
+        """
+        n_batch, n = shape_list(X)[:2]
+        pos_start = self.n_vocab + self.n_special
+
+        def sample(logits):
+            if top_k == 1:
+                return tf.argmax(logits, 1, output_type=tf.int32)
+            logits = logits / temperature
+            if top_k > 0:
+                kth = tf.nn.top_k(logits, top_k)[0][:, -1:]
+                logits = logits - 1e10*tf.cast(logits < kth, tf.float32)
+            return tf.cast(tf.multinomial(logits, 1)[:, 0], tf.int32)
+
+        def step(t, logits, past, seq):
+            x = tf.stack([sample(logits), tf.fill([n_batch], pos_start + n + t)], 1)[:, None]
+            seq = tf.concat([seq, x], 1)
+            if cache:
+                logits, present = self.lm(x, past)
+                past = [tf.concat([past[0], present[0]], 4), tf.concat([past[1], present[1]], 3)]
+            else:
+                logits, _ = self.lm(seq)
+            return t+1, logits, past, seq
+
+        logits, past = self.lm(X)
+        n_layer, n_head, n_state = self.params["n_layer"], self.params["n_head"], self.params["n_embd"] // self.params["n_head"]
+        _, logits, _, seq = tf.while_loop(lambda t, *_: t < n_tokens - 1, step, [0, logits, past, X],
+                                     shape_invariants=[tf.TensorShape([]),
+                                                       tf.TensorShape([None, self.n_vocab]),
+                                                       [tf.TensorShape([n_layer, None, n_head, n_state, None]),
+                                                        tf.TensorShape([n_layer, None, n_head, None, n_state])],
+                                                       tf.TensorShape([None, None, 2])],
+                                     back_prop=False)
+        # the last token is only sampled, its forward pass would go unused
+        return tf.concat([seq[:, n:, 0], sample(logits)[:, None]], 1)
+
+    def recompute_gradients(self, loss, params):
+        """
+        tf.gradients through the model built with recompute > 0
+        each segment of blocks is rebuilt from its checkpointed input once the
+        gradient of its output exists, so only one segment's activations are live
+        """
+        grads = tf.gradients(loss, [self.checkpoint_out] + params)
+        dh, grads = grads[0], grads[1:]
+        for x, layers in reversed(self.checkpoints):
+            with tf.control_dependencies([dh]):
+                x = tf.identity(x)
+            with tf.variable_scope('model', reuse=True):
+                h = self.blocks(x, layers, train=True)
+            segment_grads = tf.gradients(h, [x] + params, grad_ys=dh)
+            dh = segment_grads[0]
+            grads = [add_grads(a, b) for a, b in zip(grads, segment_grads[1:])]
+        embedding_grads = tf.gradients(self.embedded, params, grad_ys=dh)
+        return [add_grads(a, b) for a, b in zip(grads, embedding_grads)]
+
     def mgpu_train(self, *xs):
         gpu_ops = []
         gpu_grads = []
@@ -294,14 +688,18 @@ class Model(object):
             do_reuse = True if i > 0 else None
             with tf.device(assign_to_gpu(i, "/gpu:0")), tf.variable_scope(tf.get_variable_scope(), reuse=do_reuse):
 
-                clf_logits, clf_losses, lm_losses = self.model(*xs, train=True, reuse=do_reuse)
+                clf_logits, clf_losses, lm_losses = self.model(*xs, train=True, reuse=do_reuse, tower=i)
                 if self.params["lm_coef"] > 0:
                     train_loss = tf.reduce_mean(clf_losses) + self.params["lm_coef"] * tf.reduce_mean(lm_losses)
                 else:
                     train_loss = tf.reduce_mean(clf_losses)
 
                 params = find_trainable_variables("model")
-                grads = tf.gradients(train_loss, params)
+                # static loss scaling keeps small float16 gradients from flushing to zero
+                if self.params["recompute"] > 0:
+                    grads = self.recompute_gradients(train_loss * self.params["loss_scale"], params)
+                else:
+                    grads = tf.gradients(train_loss * self.params["loss_scale"], params)
                 grads = list(zip(grads, params))
                 gpu_grads.append(grads)
                 gpu_ops.append([clf_logits, clf_losses, lm_losses])
@@ -309,18 +707,31 @@ class Model(object):
         ops = [tf.concat(op, 0) for op in zip(*gpu_ops)]
         grads = average_grads(gpu_grads)
         grads = [g for g, p in grads]
-        train = adam(params,
-                     grads,
-                     self.params["lr"],
-                     partial(lr_schedules[self.params["lr_schedule"]],
-                             warmup=self.params["lr_warmup"]),
-                     self.n_updates_total,
-                     l2=self.params["l2"],
-                     max_grad_norm=self.params["max_grad_norm"],
-                     vector_l2=self.params["vector_l2"],
-                     b1=self.params["b1"],
-                     b2=self.params["b2"],
-                     e=self.params["e"])
+        if self.params["loss_scale"] != 1:
+            grads = scale_grads(grads, 1. / self.params["loss_scale"])
+        k = self.params["grad_accum_steps"]
+        if k > 1:
+            if self.params["sparse_embd"]:
+                print("sparse_embd: accumulated gradients are dense, the embedding gets the full adam update")
+            self.accumulate, sums = accumulate_grads(grads, params)
+            grads = [s / k if g is not None else None for s, g in zip(sums, grads)]
+        opt = opts[self.params["opt"]]
+        train = opt(params,
+                    grads,
+                    self.params["lr"],
+                    partial(lr_schedules[self.params["lr_schedule"]],
+                            warmup=self.params["lr_warmup"]),
+                    self.n_updates_total,
+                    l2=self.params["l2"],
+                    max_grad_norm=self.params["max_grad_norm"],
+                    vector_l2=self.params["vector_l2"],
+                    b1=self.params["b1"],
+                    b2=self.params["b2"],
+                    e=self.params["e"],
+                    lazy_sparse=self.params["sparse_embd"])
+        if k > 1:
+            with tf.control_dependencies([train]):
+                train = tf.group(*[s.assign(tf.zeros_like(s)) for s in sums])
 
         return [train] + ops
 
@@ -334,36 +745,44 @@ class Model(object):
         ops = [tf.concat(op, 0) for op in zip(*gpu_ops)]
         return ops
 
-    def iter_apply(self, Xs, Ms, Ys):
-        fns = [lambda x: np.concatenate(x, 0), lambda x: float(np.sum(x))]
-        results = []
-        for xmb, mmb, ymb in iter_data(Xs, Ms, Ys, n_batch=self.n_batch_train, truncate=False, verbose=True):
+    def batch(self, Xs, Ms, idx, lengths):
+        """
+        gather a batch and crop its padding to the longest example in it
+        """
+        n_ctx = int(lengths[idx].max())
+        return np.ascontiguousarray(Xs[idx, :, :n_ctx]), np.ascontiguousarray(Ms[idx, :, :n_ctx])
+
+    def iter_apply(self, Xs, Ms, Ys, lengths):
+        logits = np.zeros((len(Xs), 2), dtype=np.float32)
+        cost = 0
+        batches = ((idx, *self.batch(Xs, Ms, idx, lengths), Ys[idx])
+                   for idx in iter_buckets(lengths, n_batch=self.n_batch_train, verbose=True))
+        for (idx, xmb, mmb, ymb), _ in prefetch(batches, self.params["prefetch"]):
             n = len(xmb)
             if n == self.n_batch_train:
                 res = self.sess.run([self.eval_mgpu_logits, self.eval_mgpu_clf_loss],
                                     {self.X_train: xmb, self.M_train: mmb, self.Y_train: ymb})
             else:
                 res = self.sess.run([self.eval_logits, self.eval_clf_loss], {self.X: xmb, self.M: mmb, self.Y: ymb})
-            res = [r * n for r in res]
-            results.append(res)
-        results = zip(*results)
-        return [fn(res) for res, fn in zip(results, fns)]
-
-    def iter_predict(self, Xs, Ms):
-        logits = []
-        for xmb, mmb in iter_data(Xs, Ms, n_batch=self.n_batch_train, truncate=False, verbose=True):
+            logits[idx] = res[0]
+            cost += float(res[1] * n)
+        return logits, cost
+
+    def iter_predict(self, Xs, Ms, lengths):
+        logits = np.zeros((len(Xs), 2), dtype=np.float32)
+        batches = ((idx, *self.batch(Xs, Ms, idx, lengths))
+                   for idx in iter_buckets(lengths, n_batch=self.n_batch_train, verbose=True))
+        for (idx, xmb, mmb), _ in prefetch(batches, self.params["prefetch"]):
             n = len(xmb)
             if n == self.n_batch_train:
-                logits.append(self.sess.run(self.eval_mgpu_logits, {self.X_train: xmb, self.M_train: mmb}))
+                logits[idx] = self.sess.run(self.eval_mgpu_logits, {self.X_train: xmb, self.M_train: mmb})
             else:
-                logits.append(self.sess.run(self.eval_logits, {self.X: xmb, self.M: mmb}))
-
-        logits = np.concatenate(logits, 0)
+                logits[idx] = self.sess.run(self.eval_logits, {self.X: xmb, self.M: mmb})
         return logits
 
     def transform_roc(self, X1, X2, X3):
 
-        n_batch = len(X1)
+        n_batch = len(X1[1])-1
         xmb = np.zeros((n_batch,
                         2,
                         self.params["n_ctx"],
@@ -377,59 +796,131 @@ class Model(object):
 
         start = self.encoder['_start_']
         delimiter = self.encoder['_delimiter_']
-        for i, (x1, x2, x3), in enumerate(zip(X1, X2, X3)):
-            x12 = [start] + x1[:self.max_len] + [delimiter] + x2[:self.max_len] + [self.clf_token]
-            x13 = [start] + x1[:self.max_len] + [delimiter] + x3[:self.max_len] + [self.clf_token]
-            l12 = len(x12)
-            l13 = len(x13)
-            xmb[i, 0, :l12, 0] = x12
-            xmb[i, 1, :l13, 0] = x13
-            mmb[i, 0, :l12] = 1
-            mmb[i, 1, :l13] = 1
+        (t1, o1), (t2, o2), (t3, o3) = X1, X2, X3
+        rows = np.arange(n_batch)
+        l1 = np.minimum(np.diff(o1), self.max_len)
+        # filled one column at a time, so temporaries are batch sized rather than token or xmb sized
+        for c, (tc, oc) in enumerate([(t2, o2), (t3, o3)]):
+            lc = np.minimum(np.diff(oc), self.max_len)
+            xmb[:, c, 0, 0] = start
+            for j, r in ragged_columns(l1):
+                xmb[r, c, 1+j, 0] = t1[o1[r]+j]
+            xmb[rows, c, 1+l1, 0] = delimiter
+            for j, r in ragged_columns(lc):
+                xmb[r, c, 2+l1[r]+j, 0] = tc[oc[r]+j]
+            xmb[rows, c, 2+l1+lc, 0] = self.clf_token
+            np.less(np.arange(self.params["n_ctx"]), (3+l1+lc)[:, None], out=mmb[:, c], casting='unsafe')
         xmb[:, :, :, 1] = np.arange(self.n_vocab + self.n_special,
                                     self.n_vocab + self.n_special + self.params["n_ctx"])
         return xmb, mmb
 
-    def data_prep(self):
-
-        text_encoder = TextEncoder(self.params["encoder_path"], self.params["bpe_path"])
-        self.encoder = text_encoder.encoder
-        self.n_vocab = len(text_encoder.encoder)
-
-        (trX1, trX2, trX3, self.trY), (vaX1, vaX2, vaX3, self.vaY), (teX1, teX2, teX3) = \
-            encode_dataset(rocstories(self.params["data_dir"]),
-                           encoder=text_encoder)
-
+    def transform_choices(self, X1, Xs):
+        """
+        the inputs of choice_logits for ragged stories X1 and a list of ragged candidate sets Xs
+        the prefix is [start]+x1+[delimiter] and each candidate x+[classify], both cropped
+        to the longest example rather than padded to n_ctx
+        """
+        n_batch = len(X1[1])-1
+        start = self.encoder['_start_']
+        delimiter = self.encoder['_delimiter_']
+        pos_start = self.n_vocab + self.n_special
+        t1, o1 = X1
+        rows = np.arange(n_batch)
+        l1 = np.minimum(np.diff(o1), self.max_len)
+        r1, j1 = ragged_index(l1)
+        lcs = [np.minimum(np.diff(oc), self.max_len) for _, oc in Xs]
+        n_p, n_s = int(l1.max())+2, int(max(lc.max() for lc in lcs))+1
+
+        pmb = np.zeros((n_batch, n_p, 2), dtype=np.int32)
+        pmb[:, 0, 0] = start
+        pmb[r1, 1+j1, 0] = t1[o1[r1]+j1]
+        pmb[rows, 1+l1, 0] = delimiter
+        pmb[:, :, 1] = pos_start + np.arange(n_p)
+        pm = (np.arange(n_p) < (2+l1)[:, None]).astype(np.float32)
+
+        smb = np.zeros((n_batch, len(Xs), n_s, 2), dtype=np.int32)
+        for c, ((tc, oc), lc) in enumerate(zip(Xs, lcs)):
+            rc, jc = ragged_index(lc)
+            smb[rc, c, jc, 0] = tc[oc[rc]+jc]
+            smb[rows, c, lc, 0] = self.clf_token
+        # padding after the classify token only needs a position that exists
+        smb[:, :, :, 1] = pos_start + np.minimum((2+l1)[:, None, None] + np.arange(n_s),
+                                                 self.params["n_ctx"]-1)
+        return pmb, pm, smb
+
+    def setup_encoder(self, encoder):
+        """
+        adds the special tokens after the bpe vocabulary
+        """
+        self.encoder = encoder
+        self.n_vocab = len(self.encoder)
 
         self.encoder['_start_'] = len(self.encoder)
         self.encoder['_delimiter_'] = len(self.encoder)
         self.encoder['_classify_'] = len(self.encoder)
         self.clf_token = self.encoder['_classify_']
+
+    def data_prep(self):
+
+        cache_path = None
+        if self.params["cache_dir"]:
+            key = file_digest(*rocstories_paths(self.params["data_dir"]),
+                              self.params["encoder_path"],
+                              self.params["bpe_path"])
+            cache_path = os.path.join(self.params["cache_dir"],
+                                      'rocstories_{}_{}'.format(self.params["tokenizer"], key))
+
+        splits = load_encoded(cache_path) if cache_path is not None else None
+        if splits is None:
+            text_encoder = TextEncoder(self.params["encoder_path"],
+                                       self.params["bpe_path"],
+                                       cache_size=self.params["bpe_cache_size"],
+                                       cache_dir=self.params["cache_dir"] or None,
+                                       tokenizer=self.params["tokenizer"])
+            splits = encode_dataset(rocstories(self.params["data_dir"]),
+                                    encoder=text_encoder,
+                                    n_jobs=self.params["n_jobs"])
+            text_encoder.close()
+            text_encoder.cache.save()
+            print('bpe cache: %d entries, %d hits, %d misses' % (len(text_encoder.cache),
+                                                                 text_encoder.cache.hits,
+                                                                 text_encoder.cache.misses))
+            if cache_path is not None:
+                save_encoded(cache_path, splits)
+                splits = load_encoded(cache_path)
+            else:
+                splits = [[ragged(field) if isinstance(field, list) else field for field in split]
+                          for split in splits]
+
+        (trX1, trX2, trX3, self.trY), (vaX1, vaX2, vaX3, self.vaY), (teX1, teX2, teX3) = splits
+        self.setup_encoder(json.load(open(self.params["encoder_path"])))
         self.max_len = self.params["n_ctx"]//2-2
 
-        temp = max([len(x1[:self.max_len])+max(len(x2[:self.max_len]),
-                                               len(x3[:self.max_len])) for x1, x2, x3 in zip(trX1, trX2, trX3)] + \
-                   [len(x1[:self.max_len])+max(len(x2[:self.max_len]),
-                                               len(x3[:self.max_len])) for x1, x2, x3 in zip(vaX1, vaX2, vaX3)] + \
-                   [len(x1[:self.max_len])+max(len(x2[:self.max_len]),
-                                               len(x3[:self.max_len])) for x1, x2, x3 in zip(teX1, teX2, teX3)])
+        def roc_len(x1, x2, x3):
+            lens = [np.minimum(np.diff(x[1]), self.max_len) for x in (x1, x2, x3)]
+            return lens[0] + np.maximum(lens[1], lens[2])
+
+        temp = max(int(roc_len(*xs).max()) for xs in [(trX1, trX2, trX3),
+                                                      (vaX1, vaX2, vaX3),
+                                                      (teX1, teX2, teX3)])
 
         self.params["n_ctx"] = min(temp + 3, self.params["n_ctx"])
 
         self.trX, self.trM = self.transform_roc(trX1, trX2, trX3)
         self.vaX, self.vaM = self.transform_roc(vaX1, vaX2, vaX3)
         self.teX, self.teM = self.transform_roc(teX1, teX2, teX3)
+        self.trL, self.vaL, self.teL = [M.sum(2).max(1).astype(np.int64) for M in (self.trM, self.vaM, self.teM)]
 
         self.n_train = len(self.trY)
         self.n_valid = len(self.vaY)
         self.n_batch_train = self.params["n_batch"] * self.params["n_gpu"]
-        self.n_updates_total = (self.n_train//self.n_batch_train) * self.params["n_iter"]
+        self.n_updates_total = (self.n_train//(self.n_batch_train*self.params["grad_accum_steps"])) * self.params["n_iter"]
 
-        self.X_train = tf.placeholder(tf.int32, [self.n_batch_train, 2, self.params["n_ctx"], 2])
-        self.M_train = tf.placeholder(tf.float32, [self.n_batch_train, 2, self.params["n_ctx"]])
+        self.X_train = tf.placeholder(tf.int32, [self.n_batch_train, 2, None, 2])
+        self.M_train = tf.placeholder(tf.float32, [self.n_batch_train, 2, None])
 
-        self.X = tf.placeholder(tf.int32, [None, 2, self.params["n_ctx"], 2])
-        self.M = tf.placeholder(tf.float32, [None, 2, self.params["n_ctx"]])
+        self.X = tf.placeholder(tf.int32, [None, 2, None, 2])
+        self.M = tf.placeholder(tf.float32, [None, 2, None])
 
         self.Y_train = tf.placeholder(tf.int32, [self.n_batch_train])
         self.Y = tf.placeholder(tf.int32, [None])
@@ -441,24 +932,7 @@ class Model(object):
         params = find_trainable_variables('model')
         self.sess.run(tf.global_variables_initializer())
 
-        shapes = json.load(open('model/params_shapes.json'))
-        offsets = np.cumsum([np.prod(shape) for shape in shapes])
-        init_params = [np.load('model/params_{}.npy'.format(n)) for n in range(10)]
-        init_params = np.split(np.concatenate(init_params, 0), offsets)[:-1]
-        init_params = [param.reshape(shape) for param, shape in zip(init_params, shapes)]
-        init_params[0] = init_params[0][:self.params["n_ctx"]]
-        init_params[0] = np.concatenate([init_params[1], (np.random.randn(self.n_special,
-                                                                          self.params["n_embd"])*0.02).astype(np.float32),
-                                         init_params[0]], 0)
-        del init_params[1]
-
-        if self.params["n_transfer"] == -1:
-            self.params["n_transfer"] = 0
-        else:
-            self.params["n_transfer"] = 1 + self.params["n_transfer"] * 12
-
-        self.sess.run([p.assign(ip) for p, ip in zip(params[:self.params["n_transfer"]],
-                                                     init_params[:self.params["n_transfer"]])])
+        self.load_pretrained(params)
 
         self.eval_mgpu_logits, self.eval_mgpu_clf_losses, self.eval_mgpu_lm_losses = self.mgpu_predict(self.X_train,
                                                                                                        self.M_train,
@@ -475,29 +949,63 @@ class Model(object):
         if self.params["dataset"] != 'stsb':
             trYt = self.trY
 
-        self.save(os.path.join(self.params["save_dir"], self.params["desc"], 'best_params.jl'), params)
-
-        for i in range(self.params["n_iter"]):
-            for xmb, mmb, ymb in iter_data(*shuffle(self.trX, self.trM, trYt,
-                                                    random_state=np.random),
-                                           n_batch=self.n_batch_train,
-                                           truncate=True, verbose=True):
-                cost, _ = self.sess.run([clf_loss, train], {self.X_train: xmb, self.M_train: mmb, self.Y_train: ymb})
+        state_path = get_state_path(self.params)
+        if self.params["resume"]:
+            self.restore_state(state_path)
+        else:
+            self.save(os.path.join(self.params["save_dir"], self.params["desc"], 'best_params.ckpt'), params)
+
+        # with accumulation each micro-batch only adds its gradient, train applies the mean
+        k = self.params["grad_accum_steps"]
+        step = train if k == 1 else self.accumulate
+        while self.n_epochs < self.params["n_iter"]:
+            # the epoch's order is a function of the rng state at its start, so a resumed
+            # run redraws the same batches and skips the ones already trained on
+            if self.epoch_step == 0:
+                self.epoch_rng_state = np.random.get_state()
+            else:
+                np.random.set_state(self.epoch_rng_state)
+            idxs = iter_buckets(self.trL,
+                                n_batch=self.n_batch_train,
+                                truncate=True,
+                                random_state=np.random,
+                                pool_size=self.params["bucket_pool"],
+                                verbose=True)
+            # epoch_step counts micro-batches, trailing ones that can't fill an update are dropped
+            n_micro = (self.n_train//self.n_batch_train)//k*k
+            batches = ((*self.batch(self.trX, self.trM, idx, self.trL), trYt[idx])
+                       for idx in islice(idxs, self.epoch_step, n_micro))
+            for (xmb, mmb, ymb), wait in prefetch(batches, self.params["prefetch"]):
+                self.input_wait += wait
+                self.n_steps += 1
+                self.n_real_tokens += int(mmb.sum())
+                self.n_padded_tokens += mmb.size
+                t = time.time()
+                cost, _ = self.sess.run([clf_loss, step], {self.X_train: xmb, self.M_train: mmb, self.Y_train: ymb,
+                                                          self.step: self.n_updates*k + self.epoch_step % k})
+                self.epoch_step += 1
+                if self.epoch_step % k == 0 and k > 1:
+                    self.sess.run(train)
+                self.train_time += time.time()-t
+                self.n_examples += len(ymb)
+                if self.epoch_step % k:
+                    continue
                 self.n_updates += 1
                 if self.n_updates in [1000, 2000, 4000, 8000, 16000, 32000] and self.n_epochs == 0:
                     self.log(params)
+                if self.params["ckpt_every"] > 0 and self.n_updates % self.params["ckpt_every"] == 0:
+                    self.save_state(state_path)
             self.n_epochs += 1
+            self.epoch_step = 0
             self.log(params)
 
-        self.sess.run([p.assign(ip) for p, ip in zip(params, joblib.load(os.path.join(self.params["save_dir"],
-                                                                                      self.params["desc"],
-                                                                                      'best_params.jl')))])
+        self.restore(os.path.join(self.params["save_dir"], self.params["desc"], 'best_params.ckpt'), params)
 
     def predict(self):
         filename = file_names[self.params["dataset"]]
         pred_fn = pred_fns[self.params["dataset"]]
         label_decoder = label_decoders[self.params["dataset"]]
-        predictions = pred_fn(self.iter_predict(self.teX, self.teM))
+        predictions = pred_fn(self.iter_predict(self.teX, self.teM, self.teL))
         if label_decoder is not None:
             predictions = [label_decoder[prediction] for prediction in predictions]
         path = os.path.join(self.params["submission_dir"], filename)
@@ -512,7 +1020,29 @@ class Model(object):
                             os.path.join(self.params["log_dir"], 'rocstories.jsonl'))
 
 
-if __name__ == '__main__':
+def update_architecture(params, metadata):
+    """
+    sets the architecture in params to the one in checkpoint or exported graph metadata,
+    and the tokenizer and bpe files when it records them, so text is encoded as in training
+    """
+    params.update({k: metadata[k] for k in ['n_ctx', 'n_embd', 'n_head', 'n_layer', 'afn']})
+    params.update({k: metadata[k] for k in ['tokenizer', 'encoder_path', 'bpe_path'] if k in metadata})
+    return metadata
+
+
+def update_from_checkpoint(params, path):
+    """
+    sets the architecture in params to the one the checkpoint at path was trained with
+    returns the checkpoint metadata
+    """
+    return update_architecture(params, read_header(path)[1]['__metadata__'])
+
+
+def get_state_path(params):
+    return os.path.join(params["save_dir"], params["desc"], 'state.ckpt')
+
+
+def get_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('--desc', type=str)
     parser.add_argument('--dataset', type=str)
@@ -520,9 +1050,12 @@ if __name__ == '__main__':
     parser.add_argument('--save_dir', type=str, default='save/')
     parser.add_argument('--data_dir', type=str, default='data/')
     parser.add_argument('--submission_dir', type=str, default='submission/')
+    parser.add_argument('--cache_dir', type=str, default='cache/')
     parser.add_argument('--seed', type=int, default=42)
     parser.add_argument('--n_iter', type=int, default=3)
     parser.add_argument('--n_batch', type=int, default=8)
+    parser.add_argument('--bucket_pool', type=int, default=16)
+    parser.add_argument('--prefetch', type=int, default=2)
     parser.add_argument('--max_grad_norm', type=int, default=1)
     parser.add_argument('--lr', type=float, default=6.25e-5)
     parser.add_argument('--lr_warmup', type=float, default=0.002)
@@ -542,13 +1075,39 @@ if __name__ == '__main__':
     parser.add_argument('--lr_schedule', type=str, default='warmup_linear')
     parser.add_argument('--encoder_path', type=str, default='model/encoder_bpe_40000.json')
     parser.add_argument('--bpe_path', type=str, default='model/vocab_40000.bpe')
+    parser.add_argument('--bpe_cache_size', type=int, default=100000)
+    parser.add_argument('--n_jobs', type=int, default=1)
+    parser.add_argument('--tokenizer', type=str, default='spacy', choices=['spacy', 'regex'])
     parser.add_argument('--n_transfer', type=int, default=12)
     parser.add_argument('--lm_coef', type=float, default=0.5)
     parser.add_argument('--b1', type=float, default=0.9)
     parser.add_argument('--b2', type=float, default=0.999)
     parser.add_argument('--e', type=float, default=1e-8)
+    parser.add_argument('--sparse_embd', action='store_true')
+    parser.add_argument('--ckpt_fp16', action='store_true')
+    parser.add_argument('--ckpt_every', type=int, default=0)
+    parser.add_argument('--grad_accum_steps', type=int, default=1)
+    parser.add_argument('--precision', type=str, default='fp32', choices=sorted(compute_dtypes))
+    parser.add_argument('--loss_scale', type=float, default=1)
+    parser.add_argument('--attn_block', type=int, default=0)
+    parser.add_argument('--recompute', type=int, default=0)
+    parser.add_argument('--lm_loss', type=str, default='full', choices=['full', 'masked', 'sampled'])
+    parser.add_argument('--lm_samples', type=int, default=4096)
+    parser.add_argument('--resume', action='store_true')
+    return parser
 
+
+if __name__ == '__main__':
+    parser = get_parser()
     args = parser.parse_args()
+    if args.sparse_embd and args.lm_coef != 0:
+        parser.error('--sparse_embd needs --lm_coef 0, the tied lm head makes the embedding gradient dense')
+    if args.resume:
+        # checked before the log is opened for appending
+        if args.ckpt_every <= 0:
+            parser.error('--resume needs --ckpt_every > 0, otherwise no training state is saved')
+        if not os.path.exists(get_state_path(args.__dict__)):
+            parser.error('--resume: no training state at %s' % get_state_path(args.__dict__))
 
     m = Model(args.__dict__)
 
@@ -4,6 +4,9 @@ import sys
 import json
 import math
 import time
+import queue
+import threading
+import itertools
 import unicodedata
 import numpy as np
 import tensorflow as tf
@@ -11,17 +14,127 @@ from tensorflow.python.framework import function
 from tqdm import tqdm
 from functools import partial
 
-def encode_dataset(*splits, encoder):
+from checkpoint import atomic_path
+
+def encode_dataset(*splits, encoder, n_jobs=1):
     encoded_splits = []
     for split in splits[0]:
         fields = []
         for field in split:
             if isinstance(field[0], str):
-                field = encoder.encode(field)
+                field = encoder.encode(field, n_jobs=n_jobs)
             fields.append(field)
         encoded_splits.append(fields)
     return encoded_splits
 
+ENCODED_CACHE_VERSION = 1
+
+def ragged(seqs):
+    """
+    pack a list of token lists into flat int32 tokens and int64 offsets
+    sequence i is tokens[offsets[i]:offsets[i+1]]
+    """
+    offsets = np.zeros(len(seqs)+1, dtype=np.int64)
+    np.cumsum([len(seq) for seq in seqs], out=offsets[1:])
+    tokens = np.fromiter(itertools.chain.from_iterable(seqs), dtype=np.int32, count=int(offsets[-1]))
+    return tokens, offsets
+
+def ragged_index(lengths):
+    """
+    row and column of every element of a ragged array with the given row lengths
+    """
+    rows = np.repeat(np.arange(len(lengths)), lengths)
+    cols = np.arange(len(rows)) - np.repeat(np.cumsum(lengths)-lengths, lengths)
+    return rows, cols
+
+def ragged_columns(lengths):
+    """
+    yields (column, rows) for each column of a ragged array with the given row lengths
+    rows are the rows long enough to have that column, as slices of one longest first order
+    """
+    order = np.argsort(-lengths, kind='stable')
+    ends = np.searchsorted(-lengths[order], -np.arange(lengths.max() if len(lengths) else 0), side='left')
+    for col, end in enumerate(ends):
+        yield col, order[:end]
+
+def save_encoded(path, splits):
+    """
+    write encode_dataset output as .npy files, token fields as ragged arrays
+    the directory is built next to path and renamed into place with atomic_path
+    """
+    with atomic_path(path) as tmp_path:
+        os.makedirs(tmp_path)
+        layout = []
+        for i, split in enumerate(splits):
+            kinds = []
+            for j, field in enumerate(split):
+                if isinstance(field, np.ndarray):
+                    np.save(os.path.join(tmp_path, '{}_{}.npy'.format(i, j)), field)
+                    kinds.append('array')
+                else:
+                    tokens, offsets = ragged(field)
+                    np.save(os.path.join(tmp_path, '{}_{}_tokens.npy'.format(i, j)), tokens)
+                    np.save(os.path.join(tmp_path, '{}_{}_offsets.npy'.format(i, j)), offsets)
+                    kinds.append('ragged')
+            layout.append(kinds)
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump({'version': ENCODED_CACHE_VERSION, 'layout': layout}, f)
+
+def load_encoded(path, mmap_mode='r'):
+    """
+    inverse of save_encoded, token fields come back as (tokens, offsets) pairs
+    returns None if there is no usable cache at path
+    """
+    meta_path = os.path.join(path, 'meta.json')
+    if not os.path.exists(meta_path):
+        return None
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta['version'] != ENCODED_CACHE_VERSION:
+            return None
+        splits = []
+        for i, kinds in enumerate(meta['layout']):
+            fields = []
+            for j, kind in enumerate(kinds):
+                if kind == 'array':
+                    fields.append(np.load(os.path.join(path, '{}_{}.npy'.format(i, j)), mmap_mode=mmap_mode))
+                else:
+                    fields.append((np.load(os.path.join(path, '{}_{}_tokens.npy'.format(i, j)), mmap_mode=mmap_mode),
+                                   np.load(os.path.join(path, '{}_{}_offsets.npy'.format(i, j)),
+                                           mmap_mode=mmap_mode)))
+            splits.append(fields)
+    except (OSError, ValueError, TypeError, KeyError):
+        return None
+    return splits
+
+def iter_params(shapes, paths):
+    """
+    yields one array per entry of shapes from parameters stored flat across shard files
+    the shards are memory-mapped so a parameter inside a single shard is a zero-copy view
+    only parameters spanning a shard boundary are copied
+    """
+    shards = [np.load(path, mmap_mode='r') for path in paths]
+    shard, pos = 0, 0
+    for shape in shapes:
+        size = int(np.prod(shape))
+        pieces = []
+        while size > 0:
+            if pos == len(shards[shard]):
+                shard, pos = shard+1, 0
+                continue
+            n = min(size, len(shards[shard])-pos)
+            pieces.append(shards[shard][pos:pos+n])
+            pos += n
+            size -= n
+        if len(pieces) == 1:
+            param = pieces[0]
+        elif pieces:
+            param = np.concatenate(pieces)
+        else:
+            param = np.zeros(0, dtype=shards[0].dtype)
+        yield param.reshape(shape)
+
 def stsb_label_encoding(labels, nclass=6):
     """
     Label encoding from Tree LSTM paper (Tai, Socher, Manning)
@@ -72,11 +185,14 @@ def np_init(w):
     return partial(_np_init, w=w)
 
 class ResultLogger(object):
-    def __init__(self, path, *args, **kwargs):
+    def __init__(self, path, *args, append=False, **kwargs):
         if 'time' not in kwargs:
             kwargs['time'] = time.time()
-        self.f_log = open(make_path(path), 'w')
-        self.f_log.write(json.dumps(kwargs)+'\n')
+        if append and os.path.exists(path):
+            self.f_log = open(path, 'a')
+        else:
+            self.f_log = open(make_path(path), 'w')
+            self.f_log.write(json.dumps(kwargs)+'\n')
 
     def log(self, **kwargs):
         if 'time' not in kwargs:
@@ -114,6 +230,74 @@ def iter_data(*datas, n_batch=128, truncate=False, verbose=False, max_batches=fl
             yield (d[i:i+n_batch] for d in datas)
         n_batches += 1
 
+def iter_buckets(lengths, n_batch=128, truncate=False, random_state=None, pool_size=16, verbose=False):
+    """
+    yields index arrays of batches whose examples have similar lengths
+    so each batch only needs padding up to its own longest example
+    with random_state the examples are shuffled, sorted by length inside pools
+    of pool_size batches and the batch order is shuffled
+    without it the examples are sorted by length over the whole set
+    """
+    n = len(lengths)
+    if random_state is not None:
+        idxs = random_state.permutation(n)
+        if truncate:
+            idxs = idxs[:(n//n_batch)*n_batch]
+        pool = n_batch*pool_size
+        idxs = [p[np.argsort(lengths[p], kind='stable')] for p in np.split(idxs, range(pool, len(idxs), pool))]
+        idxs = np.concatenate(idxs)
+    else:
+        idxs = np.argsort(lengths, kind='stable')
+        if truncate:
+            idxs = idxs[:(n//n_batch)*n_batch]
+    batches = [idxs[i:i+n_batch] for i in range(0, len(idxs), n_batch)]
+    if random_state is not None:
+        batches = [batches[i] for i in random_state.permutation(len(batches))]
+    if verbose:
+        f = sys.stderr
+    else:
+        f = open(os.devnull, 'w')
+    for batch in tqdm(batches, file=f, ncols=80, leave=False):
+        yield batch
+
+class _PrefetchError(object):
+    def __init__(self, exc):
+        self.exc = exc
+
+def prefetch(batches, depth=2):
+    """
+    runs a batch generator on a background thread keeping up to depth batches ready
+    yields (batch, wait) where wait is how long the consumer blocked on the queue
+    """
+    if depth <= 0:
+        for batch in batches:
+            yield batch, 0.
+        return
+    q = queue.Queue(depth)
+    done = object()
+
+    def worker():
+        try:
+            for batch in batches:
+                q.put(batch)
+        except Exception as e:
+            q.put(_PrefetchError(e))
+        finally:
+            q.put(done)
+
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+    while True:
+        t = time.time()
+        batch = q.get()
+        wait = time.time()-t
+        if batch is done:
+            break
+        if isinstance(batch, _PrefetchError):
+            raise batch.exc
+        yield batch, wait
+    thread.join()
+
 def get_ema_if_exists(v, gvs):
     name = v.name.split(':')[0]
     ema_name = name+'/ExponentialMovingAverage:0'
@@ -131,6 +315,16 @@ def get_ema_vars(*vs):
     else:
         return vs
 
+def gather_rows(params, indices):
+    """
+    tf.gather, except that the rows of per-row int8 weights registered in the
+    'int8_rows' collection are looked up first and only those are dequantized
+    """
+    for w, q, scale in params.graph.get_collection('int8_rows'):
+        if w is params:
+            return tf.cast(tf.gather(q, indices), tf.float32) * tf.gather(scale, indices)
+    return tf.gather(params, indices)
+
 @function.Defun(
     python_grad_func=lambda x, dy: tf.convert_to_tensor(dy),
     shape_func=lambda op: [op.inputs[0].get_shape()])
@@ -149,6 +343,49 @@ def assign_to_gpu(gpu=0, ps_dev="/device:CPU:0"):
             return "/gpu:%d" % gpu
     return _assign
 
+def scale_grads(grads, scale):
+    """
+    multiplies dense and IndexedSlices gradients by scale, None passes through
+    """
+    scaled = []
+    for g in grads:
+        if isinstance(g, tf.IndexedSlices):
+            g = tf.IndexedSlices(g.values*scale, g.indices, g.dense_shape)
+        elif g is not None:
+            g = g*scale
+        scaled.append(g)
+    return scaled
+
+def add_grads(a, b):
+    """
+    sum of two gradients of the same variable, either may be None or IndexedSlices
+    """
+    if a is None:
+        return b
+    if b is None:
+        return a
+    if isinstance(a, tf.IndexedSlices) and isinstance(b, tf.IndexedSlices):
+        return tf.IndexedSlices(tf.concat([a.values, b.values], 0),
+                                tf.concat([a.indices, b.indices], 0),
+                                a.dense_shape)
+    return tf.convert_to_tensor(a) + tf.convert_to_tensor(b)
+
+def accumulate_grads(grads, params):
+    """
+    variables summing gradients over several session runs
+    returns the op adding grads into them and the variables themselves
+    """
+    sums = [tf.Variable(tf.zeros(p.get_shape()), trainable=False) for p in params]
+    ops = []
+    for s, g in zip(sums, grads):
+        if g is None:
+            continue
+        if isinstance(g, tf.IndexedSlices):
+            ops.append(tf.scatter_add(s, g.indices, g.values))
+        else:
+            ops.append(s.assign_add(g))
+    return tf.group(*ops), sums
+
 def average_grads(tower_grads):
     def average_dense(grad_and_vars):
         if len(grad_and_vars) == 1:
@@ -169,7 +406,8 @@ def average_grads(tower_grads):
             indices += [g.indices]
             values += [g.values]
         indices = tf.concat(indices, 0)
-        values = tf.concat(values, 0)
+        # duplicate rows are summed by the update, so each tower contributes its share
+        values = tf.concat(values, 0) / len(grad_and_vars)
         return tf.IndexedSlices(values, indices, grad_and_vars[0][0].dense_shape)
 
     average_grads = []